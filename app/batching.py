@@ -0,0 +1,95 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+
+class InferenceQueueFull(Exception):
+    """Hàng đợi inference đã đầy, caller nên thử lại sau"""
+
+
+class MicroBatcher:
+    """Gom các request inference đồng thời thành một batch.
+
+    Mỗi caller nhận về một Future; worker thread lấy request đầu tiên trong queue,
+    chờ thêm tối đa `max_wait_ms` để gom đủ `max_batch_size` rồi chạy một forward
+    pass duy nhất và trả kết quả về từng Future theo đúng thứ tự.
+
+    Có `num_workers` worker thread dùng chung một hàng đợi giới hạn `max_queue_size`;
+    khi hàng đợi đầy, `submit` raise InferenceQueueFull thay vì chặn caller.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[str]], List[Dict]],
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        num_workers: Optional[int] = None,
+        max_queue_size: Optional[int] = None,
+    ):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size or int(os.getenv("SENTIMENT_MAX_BATCH_SIZE", "32"))
+        self.max_wait_ms = max_wait_ms if max_wait_ms is not None else float(os.getenv("SENTIMENT_MAX_WAIT_MS", "10"))
+        self.num_workers = num_workers or int(os.getenv("SENTIMENT_INFERENCE_WORKERS", "1"))
+        self.max_queue_size = max_queue_size or int(os.getenv("SENTIMENT_MAX_QUEUE_SIZE", "256"))
+        self._queue = queue.Queue(maxsize=self.max_queue_size)
+        self._workers: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def is_saturated(self) -> bool:
+        return self._queue.full()
+
+    def submit(self, text: str) -> Future:
+        """Đưa một text vào hàng đợi, trả về Future chứa kết quả của text đó"""
+        self._ensure_started()
+        future = Future()
+        try:
+            self._queue.put_nowait((text, future))
+        except queue.Full:
+            raise InferenceQueueFull(f"Inference queue is full ({self.max_queue_size} pending)")
+        return future
+
+    def _ensure_started(self):
+        if self._workers:
+            return
+        with self._lock:
+            if not self._workers:
+                for i in range(self.num_workers):
+                    worker = threading.Thread(target=self._run, name=f"sentiment-batcher-{i}", daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+
+    def _collect_batch(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            # Bỏ qua các request đã bị caller huỷ
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.predict_batch([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
@@ -0,0 +1,274 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+# Từ vựng cho review tổng hợp; trộn từ tích cực/tiêu cực với từ trung tính
+POSITIVE_WORDS = ["great", "wonderful", "loved", "brilliant", "engaging", "beautiful", "moving", "recommend", "masterpiece", "fun"]
+NEGATIVE_WORDS = ["boring", "terrible", "waste", "awful", "predictable", "disappointing", "flat", "worst", "slow", "confusing"]
+NEUTRAL_WORDS = [
+    "the", "book", "story", "characters", "author", "plot", "chapter", "ending", "writing", "pages", "and", "was",
+    "but", "this", "it", "a", "of", "to", "in", "I", "read", "world", "series", "first", "really", "very", "with"
+]
+MAX_COMMENT_CHARS = 10000  # CommentDB.content
+
+
+def synthetic_corpus(size: int, seed: int = 42, median_words: int = 120, sigma: float = 0.9) -> List[str]:
+    """Review tổng hợp có độ dài theo phân phối log-normal (đa số ngắn, đuôi dài như review IMDB)"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(size):
+        words = max(3, min(int(rng.lognormvariate(np.log(median_words), sigma)), 2000))
+        polar = POSITIVE_WORDS if rng.random() < 0.5 else NEGATIVE_WORDS
+        tokens = [rng.choice(polar) if rng.random() < 0.15 else rng.choice(NEUTRAL_WORDS) for _ in range(words)]
+        # Thêm số thứ tự để mọi text khác nhau, tránh trúng prediction cache
+        corpus.append(f"Review {i}: " + " ".join(tokens)[:MAX_COMMENT_CHARS - 20])
+    return corpus
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss tính bằng KB trên Linux, byte trên macOS
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(usage / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(name: str, concurrency: int, latencies: List[float], errors: int, elapsed: float,
+              extra: Optional[Dict] = None) -> Dict:
+    values = np.asarray(latencies, dtype=float)
+    completed = len(latencies)
+    result = {
+        "target": name,
+        "concurrency": concurrency,
+        "requests": completed + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(completed / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(float(values.mean()), 2) if completed else None,
+            **{f"p{q}": round(float(np.percentile(values, q)), 2) if completed else None for q in (50, 95, 99)},
+            "max": round(float(values.max()), 2) if completed else None
+        },
+        "peak_rss_mb": peak_rss_mb()
+    }
+    result.update(extra or {})
+    print(f"{name:<18} c={concurrency:<4} rps={result['throughput_rps']:<9} "
+          f"p50={result['latency_ms']['p50']}ms p95={result['latency_ms']['p95']}ms "
+          f"p99={result['latency_ms']['p99']}ms errors={errors} rss={result['peak_rss_mb']}MB")
+    return result
+
+
+def run_threaded(call: Callable[[str], object], texts: List[str], concurrency: int):
+    latencies, errors = [], 0
+
+    def timed(text: str):
+        started = time.perf_counter()
+        call(text)
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(timed, text) for text in texts]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    return latencies, errors, time.perf_counter() - started
+
+
+def bench_analyzer(analyzer, corpus: List[str], levels: List[int], requests: int) -> List[Dict]:
+    """Gọi SentimentAnalyzer trực tiếp: micro-batcher + tokenization + forward pass"""
+    results = []
+    offset = 0
+    for concurrency in levels:
+        texts = corpus[offset:offset + requests]
+        offset += requests
+        latencies, errors, elapsed = run_threaded(analyzer.analyze_text, texts, concurrency)
+        results.append(summarize("analyzer", concurrency, latencies, errors, elapsed))
+
+    # Đường bulk: một lần gọi analyze_batch, không qua micro-batcher
+    texts = corpus[offset:offset + requests]
+    started = time.perf_counter()
+    analyzer.analyze_batch(texts)
+    elapsed = time.perf_counter() - started
+    results.append(summarize("analyzer_bulk", 1, [elapsed * 1000 / len(texts)] * len(texts), 0, elapsed))
+    return results
+
+
+async def bench_api(app, book_id: str, corpus: List[str], levels: List[int], requests: int) -> List[Dict]:
+    """Chạy FastAPI app trong cùng process qua httpx ASGI transport (không có mạng)"""
+    try:
+        import httpx
+    except ImportError:
+        raise RuntimeError("httpx is required for the API benchmark: pip install httpx")
+
+    results = []
+    offset = 0
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://localhost", timeout=300) as client:
+        for concurrency in levels:
+            texts = corpus[offset:offset + requests]
+            offset += requests
+            semaphore = asyncio.Semaphore(concurrency)
+            statuses: Dict[int, int] = {}
+            latencies: List[float] = []
+
+            async def create(text: str):
+                async with semaphore:
+                    started = time.perf_counter()
+                    response = await client.post(f"/books/{book_id}/comments", json={
+                        "content": text, "user_id": "bench", "user_name": "Benchmark"
+                    })
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                    if response.status_code < 300:
+                        latencies.append((time.perf_counter() - started) * 1000)
+
+            started = time.perf_counter()
+            await asyncio.gather(*(create(text) for text in texts))
+            elapsed = time.perf_counter() - started
+            errors = sum(count for status, count in statuses.items() if status >= 300)
+            results.append(summarize("api_create", concurrency, latencies, errors, elapsed,
+                                     {"status_codes": {str(k): v for k, v in sorted(statuses.items())}}))
+
+        # Đọc: phân trang comments của sách vừa ghi
+        latencies, errors = [], 0
+        started = time.perf_counter()
+        for _ in range(min(requests, 200)):
+            request_started = time.perf_counter()
+            response = await client.get(f"/books/{book_id}/comments-with-sentiment", params={"limit": 50})
+            if response.status_code == 200:
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            else:
+                errors += 1
+        results.append(summarize("api_comments_page", 1, latencies, errors, time.perf_counter() - started))
+    return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(current: Dict, baseline_path: str):
+    """In thay đổi throughput và p95 so với một file kết quả trước đó"""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {(r["target"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nCompared with {baseline_path} ({baseline['meta'].get('commit')}):")
+    for result in current["results"]:
+        before = previous.get((result["target"], result["concurrency"]))
+        if not before or not before["throughput_rps"] or before["latency_ms"]["p95"] is None or result["latency_ms"]["p95"] is None:
+            continue
+        rps = (result["throughput_rps"] / before["throughput_rps"] - 1) * 100
+        p95 = (result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1) * 100
+        print(f"  {result['target']:<18} c={result['concurrency']:<4} throughput {rps:+.1f}%  p95 {p95:+.1f}%")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sentiment inference and the API end to end")
+    parser.add_argument("--target", choices=["analyzer", "api", "all"], default="all")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--model-path", help="Checkpoint to benchmark (default: SENTIMENT_MODEL_PATH)")
+    parser.add_argument("--backend", help="Inference backend (default: SENTIMENT_BACKEND)")
+    parser.add_argument("--database-url", help="Database to use (default: a fresh SQLite file)")
+    parser.add_argument("--use-cache", action="store_true", help="Keep the prediction cache enabled")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="Previous results file to diff against")
+    args = parser.parse_args()
+
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    workdir = tempfile.mkdtemp(prefix="sentiment-bench-")
+    # Phải đặt trước khi import app: database và analyzer đọc cấu hình lúc import
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["SENTIMENT_LOAD_MODE"] = "lazy"
+    os.environ["COMMENT_SCORING_MODE"] = "sync"
+    if not args.use_cache:
+        os.environ["PREDICTION_CACHE_SIZE"] = "0"
+        os.environ["PREDICTION_CACHE_DISK"] = ""
+    if args.model_path:
+        os.environ["SENTIMENT_MODEL_PATH"] = args.model_path
+    if args.backend:
+        os.environ["SENTIMENT_BACKEND"] = args.backend
+
+    started = time.perf_counter()
+    from . import crud, database, models
+    from .main import app
+    import_s = time.perf_counter() - started
+
+    analyzer = crud.sentiment_analyzer
+    analyzer.wait_until_ready()
+    print(f"Model {analyzer.registry.active.version} ready: {analyzer.startup_timings}")
+
+    targets = ["analyzer", "api"] if args.target == "all" else [args.target]
+    corpus = synthetic_corpus(args.requests * (len(levels) + 1) * len(targets), seed=args.seed)
+    lengths = np.asarray([len(text.split()) for text in corpus])
+    results = []
+
+    if "analyzer" in targets:
+        results += bench_analyzer(analyzer, corpus[:len(corpus) // len(targets)], levels, args.requests)
+
+    if "api" in targets:
+        book_id = "benchmark-book"
+        with database.session_scope() as db:
+            if not crud.book_exists(db, book_id):
+                db.add(models.BookDB(id=book_id, title="Benchmark", author="bench", price=0.0,
+                                     description="Synthetic benchmark book", imageUrl=""))
+
+        async def run_api():
+            await app.router.startup()
+            try:
+                return await bench_api(app, book_id, corpus[-(len(corpus) // len(targets)):], levels, args.requests)
+            finally:
+                await app.router.shutdown()
+
+        results += asyncio.run(run_api())
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "backend": analyzer.backend_name,
+            "model_version": analyzer.registry.active.version,
+            "truncation": analyzer.truncation,
+            "prediction_cache": args.use_cache,
+            "database": "sqlite" if not args.database_url else args.database_url.split(":", 1)[0],
+            "seed": args.seed,
+            "corpus_words": {
+                "mean": round(float(lengths.mean()), 1),
+                "p50": int(np.percentile(lengths, 50)),
+                "p95": int(np.percentile(lengths, 95)),
+                "max": int(lengths.max())
+            },
+            "import_s": round(import_s, 3),
+            "startup_timings": analyzer.startup_timings,
+            "peak_rss_mb": peak_rss_mb()
+        },
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+import uuid
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Set, TextIO
+
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+def detect_format(filename: str) -> str:
+    return "csv" if filename.lower().endswith(".csv") else "jsonl"
+
+
+# Dòng JSONL không decode được; vẫn chiếm một offset để resume không bị lệch
+INVALID_RECORD = None
+
+MAX_CONTENT_LENGTH = models.CommentDB.__table__.c.content.type.length
+
+
+def read_records(stream: TextIO, fmt: str) -> Iterator[Optional[Dict]]:
+    """Đọc từng review từ file JSONL hoặc CSV mà không nạp cả file vào bộ nhớ.
+
+    Dòng JSONL lỗi trả về INVALID_RECORD thay vì raise: nếu không, mỗi lần resume sẽ
+    dừng lại đúng ở dòng đó và backfill không bao giờ đi qua được.
+    """
+    if fmt == "csv":
+        yield from csv.DictReader(stream)
+    elif fmt == "jsonl":
+        for line in stream:
+            line = line.strip()
+            if line:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    yield INVALID_RECORD
+    else:
+        raise ValueError(f"Unsupported format: {fmt}")
+
+
+def load_checkpoint(path: str) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        return int(json.load(f).get("offset", 0))
+
+
+def save_checkpoint(path: str, offset: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"offset": offset, "updated_at": datetime.utcnow().isoformat()}, f)
+    os.replace(tmp_path, path)
+
+
+class BulkScorer:
+    """Chấm điểm hàng loạt review lịch sử và ghi CommentDB + PredictionLog bằng bulk insert"""
+
+    def __init__(self, analyzer, batch_size: Optional[int] = None):
+        self.analyzer = analyzer
+        self.batch_size = batch_size or int(os.getenv("BULK_BATCH_SIZE", "256"))
+        self.committed_offset = 0
+
+    def run(self, db: Session, records: Iterable[Dict], default_book_id: str = None,
+            start_offset: int = 0, checkpoint_path: str = None) -> Dict:
+        """
+        Args:
+            db: SQLAlchemy Session object
+            records: Các dict có `content` (hoặc `text`), tuỳ chọn `book_id`, `user_id`, `user_name`, `timestamp`
+            default_book_id: book_id dùng khi record không có
+            start_offset: Số record đầu tiên bỏ qua (resume từ checkpoint)
+            checkpoint_path: File lưu offset sau mỗi batch đã commit
+        """
+        start_time = time.time()
+        offset = start_offset
+        self.committed_offset = start_offset
+        processed = 0
+        skipped = 0
+        rows = itertools.islice(records, start_offset, None)
+
+        while True:
+            chunk = list(itertools.islice(rows, self.batch_size))
+            if not chunk:
+                break
+            known_books = self._known_books(db, chunk, default_book_id)
+            valid = [r for r in (self._parse(record, default_book_id, known_books) for record in chunk) if r is not None]
+            skipped += len(chunk) - len(valid)
+
+            if valid:
+                self._score_and_insert(db, valid)
+            offset += len(chunk)
+            processed += len(valid)
+            self.committed_offset = offset
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, offset)
+
+            elapsed = time.time() - start_time
+            print(f"Bulk scoring: offset={offset} processed={processed} "
+                  f"({processed / elapsed if elapsed > 0 else 0:.1f} rows/sec)")
+
+        elapsed = time.time() - start_time
+        return {
+            "processed": processed,
+            "skipped": skipped,
+            "offset": offset,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_sec": round(processed / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+    @staticmethod
+    def _book_id(record, default_book_id: str) -> Optional[str]:
+        book_id = record.get("book_id") if isinstance(record, dict) else None
+        book_id = book_id or default_book_id
+        return str(book_id) if book_id else None
+
+    def _known_books(self, db: Session, chunk: List, default_book_id: str) -> Set[str]:
+        """book_id của chunk có trong bảng books, đọc bằng một query"""
+        book_ids = {self._book_id(record, default_book_id) for record in chunk} - {None}
+        if not book_ids:
+            return set()
+        return {book_id for (book_id,) in db.query(models.BookDB.id).filter(models.BookDB.id.in_(book_ids))}
+
+    def _parse(self, record, default_book_id: str, known_books: Set[str]) -> Optional[Dict]:
+        """Record đã chuẩn hoá, hoặc None để bỏ qua (và đếm vào skipped).
+
+        Mọi giá trị có thể làm hỏng bulk insert của cả chunk đều bị loại ở đây: dòng lỗi,
+        content rỗng/quá dài, book không tồn tại (lỗi FK), timestamp sai định dạng.
+        Nếu không, offset resume sẽ kẹt mãi ở chunk đó.
+        """
+        if not isinstance(record, dict):
+            return None
+        content = record.get("content") or record.get("text")
+        if not isinstance(content, str) or not content.strip() or len(content) > MAX_CONTENT_LENGTH:
+            return None
+        book_id = self._book_id(record, default_book_id)
+        if book_id not in known_books:
+            return None
+        timestamp = record.get("timestamp")
+        if timestamp:
+            try:
+                timestamp = datetime.fromisoformat(timestamp)
+            except (TypeError, ValueError):
+                return None
+        return {
+            "content": content,
+            "book_id": book_id,
+            "user_id": str(record.get("user_id") or "bulk-import")[:36],
+            "user_name": str(record.get("user_name") or "Imported review")[:255],
+            "timestamp": timestamp or None
+        }
+
+    def _score_and_insert(self, db: Session, records: List[Dict]):
+        texts = [r["content"] for r in records]
+        batch_start = time.time()
+        results = self.analyzer.analyze_batch(texts)
+        per_row_ms = (time.time() - batch_start) * 1000 / len(texts)
+
+        now = datetime.utcnow()
+        comments = []
+        logs = []
+        for record, text, result in zip(records, texts, results):
+            comment_id = str(uuid.uuid4())
+            sentiment = result["sentiment"].lower()
+            comments.append({
+                "id": comment_id,
+                "content": text,
+                "userId": record["user_id"],
+                "userName": record["user_name"],
+                "sentiment": sentiment,
+                "timestamp": record["timestamp"] or now,
+                "book_id": record["book_id"]
+            })
+            logs.append({
+                "id": str(uuid.uuid4()),
+                "timestamp": now,
+                "text": text[:1000],
+                "predicted_sentiment": sentiment,
+                "confidence_score": result["score"],
+                "response_time": per_row_ms,
+                "comment_id": comment_id,
+                "model_version": result.get("model_version")
+            })
+
+        try:
+            db.bulk_insert_mappings(models.CommentDB, comments)
+            db.bulk_insert_mappings(models.PredictionLog, logs)
+            self._update_summary(db, comments)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+
+    @staticmethod
+    def _update_summary(db: Session, comments: List[Dict]):
+        from .crud import apply_book_sentiment_delta
+
+        deltas: Dict[str, Dict[str, int]] = {}
+        for comment in comments:
+            delta = deltas.setdefault(comment["book_id"], {"total": 0, "positive": 0, "negative": 0})
+            delta["total"] += 1
+            if comment["sentiment"] in ("positive", "negative"):
+                delta[comment["sentiment"]] += 1
+        for book_id, delta in deltas.items():
+            apply_book_sentiment_delta(db, book_id, **delta)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk sentiment scoring for historical reviews")
+    parser.add_argument("input", help="Path to a .jsonl or .csv file")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="Input format (default: from file extension)")
+    parser.add_argument("--book-id", help="book_id for records that do not specify one")
+    parser.add_argument("--batch-size", type=int, help="Rows per model batch and per bulk insert")
+    parser.add_argument("--checkpoint", help="Checkpoint file storing the last committed offset")
+    parser.add_argument("--offset", type=int, help="Start from this record offset (overrides --checkpoint)")
+    args = parser.parse_args()
+
+    from .crud import sentiment_analyzer
+    from .database import SessionLocal
+
+    start_offset = args.offset if args.offset is not None else load_checkpoint(args.checkpoint)
+    scorer = BulkScorer(sentiment_analyzer, batch_size=args.batch_size)
+    db = SessionLocal()
+    try:
+        with open(args.input, "r", encoding="utf-8", newline="") as f:
+            records = read_records(f, args.format or detect_format(args.input))
+            stats = scorer.run(db, records, default_book_id=args.book_id,
+                               start_offset=start_offset, checkpoint_path=args.checkpoint)
+    finally:
+        db.close()
+    print(json.dumps(stats, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import csv
+import glob
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+CSV_HEADER = ['timestamp', 'text', 'predicted_sentiment', 'correct_sentiment', 'confidence_score', 'comment_id']
+
+
+class CorrectionStore:
+    """Lưu các lần người dùng sửa sentiment sai, đánh index theo comment_id.
+
+    Dùng sqlite nên upsert là O(log n) trên B-tree thay vì đọc và ghi lại cả file CSV,
+    và an toàn khi nhiều worker cùng ghi. Số lỗi mỗi tháng được duy trì trong bảng
+    `correction_counts`, nên thống kê không cần quét dữ liệu.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.path.join(os.getenv("TRAINING_DATA_DIR", "training_data"), "sentiment_errors.sqlite")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        is_new = not os.path.exists(self.path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS corrections ("
+            "comment_id TEXT PRIMARY KEY, month TEXT NOT NULL, timestamp TEXT NOT NULL, text TEXT, "
+            "predicted_sentiment TEXT, correct_sentiment TEXT, confidence_score REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS ix_corrections_month ON corrections (month)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS correction_counts (month TEXT PRIMARY KEY, total INTEGER NOT NULL)"
+        )
+        if is_new:
+            self._import_legacy_csv()
+
+    def upsert(self, comment_id: str, text: str, predicted_sentiment: str,
+               correct_sentiment: str, confidence_score: float, timestamp: datetime = None) -> bool:
+        """Thêm hoặc cập nhật correction của một comment. Trả về True nếu là bản ghi mới"""
+        timestamp = timestamp or datetime.utcnow()
+        month = timestamp.strftime('%Y%m')
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT month FROM corrections WHERE comment_id = ?", (comment_id,)
+                ).fetchone()
+                self._conn.execute(
+                    "INSERT INTO corrections (comment_id, month, timestamp, text, predicted_sentiment, "
+                    "correct_sentiment, confidence_score) VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(comment_id) DO UPDATE SET month = excluded.month, timestamp = excluded.timestamp, "
+                    "text = excluded.text, predicted_sentiment = excluded.predicted_sentiment, "
+                    "correct_sentiment = excluded.correct_sentiment, confidence_score = excluded.confidence_score",
+                    (comment_id, month, timestamp.isoformat(), text, predicted_sentiment,
+                     correct_sentiment, confidence_score)
+                )
+                if row is None or row[0] != month:
+                    self._increment(month, 1)
+                    if row is not None:
+                        self._increment(row[0], -1)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        logger.info(f"{'Added new' if row is None else 'Updated'} correction for comment {comment_id}")
+        return row is None
+
+    def _increment(self, month: str, delta: int):
+        self._conn.execute(
+            "INSERT INTO correction_counts (month, total) VALUES (?, ?) "
+            "ON CONFLICT(month) DO UPDATE SET total = total + excluded.total",
+            (month, delta)
+        )
+
+    def count(self, month: Optional[str] = None) -> int:
+        """Số correction trong tháng `month` (YYYYMM), mặc định là tháng hiện tại"""
+        month = month or datetime.utcnow().strftime('%Y%m')
+        with self._lock:
+            row = self._conn.execute("SELECT total FROM correction_counts WHERE month = ?", (month,)).fetchone()
+        return row[0] if row else 0
+
+    def export_csv(self, file_path: str, month: Optional[str] = None) -> int:
+        """Xuất corrections của một tháng ra CSV cùng định dạng file log cũ để training"""
+        month = month or datetime.utcnow().strftime('%Y%m')
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT timestamp, text, predicted_sentiment, correct_sentiment, confidence_score, comment_id "
+                "FROM corrections WHERE month = ? ORDER BY timestamp", (month,)
+            ).fetchall()
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(CSV_HEADER)
+            writer.writerows(rows)
+        return len(rows)
+
+    def _import_legacy_csv(self):
+        """Nạp các file sentiment_errors_YYYYMM.csv cũ khi store được tạo lần đầu"""
+        pattern = os.path.join(os.path.dirname(os.path.abspath(self.path)), "sentiment_errors_*.csv")
+        for file_path in sorted(glob.glob(pattern)):
+            with open(file_path, 'r', newline='', encoding='utf-8') as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    try:
+                        self.upsert(
+                            comment_id=row['comment_id'],
+                            text=row['text'],
+                            predicted_sentiment=row['predicted_sentiment'],
+                            correct_sentiment=row['correct_sentiment'],
+                            confidence_score=float(row['confidence_score'] or 0),
+                            timestamp=datetime.fromisoformat(row['timestamp'])
+                        )
+                    except (KeyError, ValueError) as e:
+                        logger.error(f"Skipping malformed row in {file_path}: {e}")
+            logger.info(f"Imported legacy error log {file_path}")
+
+
+_store: Optional[CorrectionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_correction_store() -> CorrectionStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = CorrectionStore()
+    return _store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export sentiment corrections for retraining")
+    parser.add_argument("output", help="CSV file to write")
+    parser.add_argument("--month", help="Month as YYYYMM (default: current month)")
+    args = parser.parse_args()
+    count = get_correction_store().export_csv(args.output, args.month)
+    print(f"Exported {count} corrections to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
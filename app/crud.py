@@ -1,22 +1,53 @@
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import desc, func, case, or_, and_, select
+import base64
+import json
 import uuid
 from datetime import datetime
+from typing import Optional
 from . import models
 from .sentiment_service import SentimentAnalyzer
+from .batching import InferenceQueueFull
+from .scoring_queue import ScoringQueue
 from typing import Dict, List
 from . import crud, models, database
 from .database import engine, get_db
 sentiment_analyzer = SentimentAnalyzer()
+scoring_queue = ScoringQueue(sentiment_analyzer)
+
+def _with_comments_and_replies(query):
+    # Nạp comments và replies bằng 2 query IN thay vì lazy load cho từng book/comment;
+    # thứ tự comments theo timestamp giảm dần được khai báo trên relationship
+    return query.options(
+        selectinload(models.BookDB.comments).selectinload(models.CommentDB.replies)
+    )
 
 def get_books(db: Session):
-    return db.query(models.BookDB).all()
+    return _with_comments_and_replies(db.query(models.BookDB)).all()
 
 def get_book(db: Session, book_id: str):
-    book = db.query(models.BookDB).filter(models.BookDB.id == book_id).first()
-    if book:
-        book.comments.sort(key=lambda x: x.timestamp, reverse=True)
-    return book
+    return _with_comments_and_replies(db.query(models.BookDB))\
+        .filter(models.BookDB.id == book_id)\
+        .first()
+
+def get_books_summary(db: Session) -> List[Dict]:
+    """Danh sách sách kèm số comment theo sentiment, không nạp comments"""
+    Summary = models.BookSentimentSummary
+    rows = db.query(models.BookDB, Summary.total, Summary.positive, Summary.negative)\
+        .outerjoin(Summary, Summary.book_id == models.BookDB.id)\
+        .all()
+    return [{
+        "id": book.id,
+        "title": book.title,
+        "author": book.author,
+        "price": book.price,
+        "description": book.description,
+        "imageUrl": book.imageUrl,
+        "sentiment": {"total": total or 0, "positive": positive or 0, "negative": negative or 0}
+    } for book, total, positive, negative in rows]
+
+def book_exists(db: Session, book_id: str) -> bool:
+    return db.query(models.BookDB.id).filter(models.BookDB.id == book_id).first() is not None
 
 def get_book_comments(db: Session, book_id: str):
     return db.query(models.CommentDB)\
@@ -24,10 +55,45 @@ def get_book_comments(db: Session, book_id: str):
         .order_by(desc(models.CommentDB.timestamp))\
         .all()
 
+def encode_comment_cursor(comment: models.CommentDB) -> str:
+    payload = json.dumps([comment.timestamp.isoformat(), comment.id])
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii")
+
+def decode_comment_cursor(cursor: str):
+    try:
+        timestamp, comment_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return datetime.fromisoformat(timestamp), comment_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def get_book_comments_page(db: Session, book_id: str, sentiment: str = None, limit: int = 100, cursor: str = None):
+    """Keyset pagination theo (timestamp, id) giảm dần, lọc sentiment ngay trong SQL"""
+    query = db.query(models.CommentDB)\
+        .options(selectinload(models.CommentDB.replies))\
+        .filter(models.CommentDB.book_id == book_id)
+    if sentiment:
+        query = query.filter(models.CommentDB.sentiment == sentiment)
+    if cursor:
+        timestamp, comment_id = decode_comment_cursor(cursor)
+        query = query.filter(or_(
+            models.CommentDB.timestamp < timestamp,
+            and_(models.CommentDB.timestamp == timestamp, models.CommentDB.id < comment_id)
+        ))
+    comments = query.order_by(desc(models.CommentDB.timestamp), desc(models.CommentDB.id))\
+        .limit(limit + 1)\
+        .all()
+
+    next_cursor = encode_comment_cursor(comments[limit - 1]) if len(comments) > limit else None
+    return comments[:limit], next_cursor
+
 def get_comment_replies(db: Session, comment_id: str):
     return db.query(models.ReplyDB).filter(models.ReplyDB.comment_id == comment_id).all()
 
-async def create_comment(db: Session, book_id: str, user_id: str, user_name: str, content: str):
+async def create_comment(db: Session, book_id: str, user_id: str, user_name: str, content: str,
+                         background: bool = False):
+    # Từ chối sớm khi model đang quá tải để không ghi comment mà không chấm điểm được
+    if not background and sentiment_analyzer.is_saturated():
+        raise InferenceQueueFull("Sentiment model is busy, please retry later")
     try:
         # Tạo comment trước với sentiment là null
         comment = models.CommentDB(
@@ -40,20 +106,24 @@ async def create_comment(db: Session, book_id: str, user_id: str, user_name: str
             book_id=book_id
         )
         db.add(comment)
+        adjust_book_sentiment_summary(db, book_id, total=1)
         db.commit()
         db.refresh(comment)
         comment_id = str(comment.id)
+        if background:
+            # Trả về ngay, worker sẽ chấm điểm, lưu và broadcast sau
+            scoring_queue.enqueue(comment_id)
+            return comment
         # Phân tích sentiment bất đồng bộ và broadcast kết quả
         sentiment = await sentiment_analyzer.analyze_and_broadcast(content, comment.id, db=db)
         
         # Cập nhật sentiment vào database
         if sentiment:
-
-            comment = db.query(models.CommentDB).filter(models.CommentDB.id == comment_id).first()
-            if comment:
-                comment.sentiment = sentiment
-                db.commit()
-                db.refresh(comment)
+            comment = update_comment_sentiment(db, comment_id, sentiment) or comment
+        else:
+            # Hàng đợi model đầy sau khi qua kiểm tra is_saturated (hoặc model lỗi): comment
+            # đã được lưu, chuyển cho scoring queue chấm điểm lại có backoff
+            scoring_queue.enqueue(comment_id)
         
         return comment
     except Exception as e:
@@ -75,15 +145,8 @@ def create_reply(db: Session, comment_id: str, admin_id: str, admin_name: str, c
     db.refresh(reply)
     return reply
 
-def get_sentiment_stats(db: Session, book_id: str = None):
-    query = db.query(models.CommentDB)
-    if book_id:
-        query = query.filter(models.CommentDB.book_id == book_id)
-    
-    total = query.count()
-    positive = query.filter(models.CommentDB.sentiment == "positive").count()
-    negative = query.filter(models.CommentDB.sentiment == "negative").count()
-    
+def _format_sentiment_stats(total: int, positive: int, negative: int) -> Dict:
+    total, positive, negative = int(total or 0), int(positive or 0), int(negative or 0)
     return {
         "total": total,
         "positive": positive,
@@ -92,9 +155,81 @@ def get_sentiment_stats(db: Session, book_id: str = None):
         "negative_percentage": (negative/total * 100) if total > 0 else 0
     }
 
+def adjust_book_sentiment_summary(db: Session, book_id: str, total: int = 0,
+                                  old_sentiment: str = None, new_sentiment: str = None):
+    """Cập nhật bảng book_sentiment_summary trong transaction hiện tại (caller tự commit)"""
+    delta = {"total": total, "positive": 0, "negative": 0}
+    if old_sentiment in ("positive", "negative"):
+        delta[old_sentiment] -= 1
+    if new_sentiment in ("positive", "negative"):
+        delta[new_sentiment] += 1
+    apply_book_sentiment_delta(db, book_id, **delta)
+
+def apply_book_sentiment_delta(db: Session, book_id: str, total: int = 0, positive: int = 0, negative: int = 0):
+    if not (total or positive or negative):
+        return
+    # Một câu upsert: hai comment đầu tiên của cùng một sách không cùng INSERT rồi lỗi trùng khóa
+    table = models.BookSentimentSummary.__table__
+    db.execute(database.upsert_statement(
+        db, table, ["book_id"],
+        lambda new: {column: table.c[column] + new[column] for column in ("total", "positive", "negative")},
+        values={"book_id": book_id, "total": total, "positive": positive, "negative": negative}
+    ))
+
+def rebuild_sentiment_summary(db: Session):
+    """Tính lại bảng tổng hợp tại chỗ bằng một câu INSERT ... SELECT GROUP BY có upsert.
+
+    Không xóa rồi insert lại: worker khác vẫn đọc và cộng dồn vào bảng trong lúc rebuild.
+    """
+    table = models.BookSentimentSummary.__table__
+    counts = select(
+        models.CommentDB.book_id,
+        func.count(models.CommentDB.id).label("total"),
+        func.coalesce(func.sum(case((models.CommentDB.sentiment == "positive", 1), else_=0)), 0).label("positive"),
+        func.coalesce(func.sum(case((models.CommentDB.sentiment == "negative", 1), else_=0)), 0).label("negative")
+    ).where(models.CommentDB.book_id.isnot(None)).group_by(models.CommentDB.book_id)
+    db.execute(database.upsert_statement(
+        db, table, ["book_id"],
+        lambda new: {column: new[column] for column in ("total", "positive", "negative")},
+        select=counts
+    ))
+    # Sách không còn comment nào
+    db.query(models.BookSentimentSummary).filter(
+        ~models.BookSentimentSummary.book_id.in_(select(models.CommentDB.book_id).where(models.CommentDB.book_id.isnot(None)))
+    ).delete(synchronize_session=False)
+    db.commit()
+
+def get_sentiment_stats(db: Session, book_id: str = None):
+    Summary = models.BookSentimentSummary
+    if book_id:
+        row = db.query(Summary.total, Summary.positive, Summary.negative)\
+            .filter(Summary.book_id == book_id).first()
+    else:
+        row = db.query(func.sum(Summary.total), func.sum(Summary.positive), func.sum(Summary.negative)).first()
+    return _format_sentiment_stats(*(row or (0, 0, 0)))
+
+def get_all_book_sentiment_stats(db: Session, book_ids=None) -> List[Dict]:
+    """Thống kê sentiment của mọi sách (hoặc các sách trong `book_ids`) trong một query"""
+    Summary = models.BookSentimentSummary
+    query = db.query(models.BookDB.id, models.BookDB.title, Summary.total, Summary.positive, Summary.negative)\
+        .outerjoin(Summary, Summary.book_id == models.BookDB.id)
+    if book_ids is not None:
+        query = query.filter(models.BookDB.id.in_(list(book_ids)))
+    rows = query.all()
+    return [{
+        "id": book_id,
+        "title": title,
+        "stats": _format_sentiment_stats(total, positive, negative)
+    } for book_id, title, total, positive, negative in rows]
+
+def get_comment_sentiment(db: Session, comment_id: str) -> Optional[str]:
+    return db.query(models.CommentDB.sentiment).filter(models.CommentDB.id == comment_id).scalar()
+
 def update_comment_sentiment(db: Session, comment_id: str, sentiment: str):
     comment = db.query(models.CommentDB).filter(models.CommentDB.id == comment_id).first()
     if comment:
+        if comment.sentiment != sentiment:
+            adjust_book_sentiment_summary(db, comment.book_id, old_sentiment=comment.sentiment, new_sentiment=sentiment)
         comment.sentiment = sentiment
         db.commit()
         db.refresh(comment)
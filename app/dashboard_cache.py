@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .database import session_scope
+from .metrics_aggregator import metrics_aggregator
+from .metrics_service import MetricsService
+
+
+class DashboardCache:
+    """Snapshot của /api/dashboard/metrics được tính sẵn ở background và phục vụ từ bộ nhớ.
+
+    Mỗi `refresh_interval` giây refresher đọc tổng metrics của cửa sổ từ metrics_rollups
+    và các correction gần nhất. ETag được tính từ chính dữ liệu dùng chung đó (bucket
+    mới nhất, các bộ đếm, correction), không từ trạng thái của worker, nên mọi worker
+    trả cùng ETag cho cùng một trạng thái và client polling nhận 304 dù request tới
+    worker nào. Body JSON chỉ được serialize lại khi ETag đổi.
+    """
+
+    def __init__(self, refresh_interval: Optional[float] = None):
+        self.refresh_interval = refresh_interval or float(os.getenv("DASHBOARD_REFRESH_INTERVAL_S", "1"))
+        # (body, etag) được thay bằng một phép gán để request không ghép ETag mới với body cũ
+        self._snapshot: Tuple[Optional[bytes], Optional[str]] = (None, None)
+        self.generated_at = 0.0
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def etag_of(window_metrics: Dict, recent_corrections: List[Dict]) -> str:
+        state = json.dumps([window_metrics, recent_corrections], separators=(",", ":"), sort_keys=True)
+        return f'"{hashlib.sha1(state.encode("utf-8")).hexdigest()}"'
+
+    def refresh(self) -> bool:
+        """Tính lại snapshot (blocking); trả về False nếu không lấy được metrics"""
+        with self._lock:
+            with session_scope() as db:
+                window_metrics = metrics_aggregator.snapshot(db)
+                metrics = MetricsService(db).get_dashboard_metrics(window_metrics)
+            if not metrics:
+                return False
+            etag = self.etag_of(window_metrics, metrics["recent_corrections"])
+            if etag != self._snapshot[1]:
+                body = json.dumps({"success": True, "data": metrics}, separators=(",", ":")).encode("utf-8")
+                self._snapshot = (body, etag)
+            self.generated_at = time.time()
+            return True
+
+    @property
+    def snapshot(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """Body và ETag hiện tại (có thể là (None, None)), không chặn"""
+        return self._snapshot
+
+    def get(self) -> Tuple[Optional[bytes], Optional[str]]:
+        """Body và ETag hiện tại; tự tính nếu chưa có snapshot nào (trước lần refresh đầu tiên)"""
+        if self._snapshot[0] is None:
+            self.refresh()
+        return self._snapshot
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"Error refreshing dashboard snapshot: {e}")
+            await asyncio.sleep(self.refresh_interval)
+
+
+dashboard_cache = DashboardCache()
@@ -1,15 +1,30 @@
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Sử dụng credentials từ docker-compose.yml
-SQLALCHEMY_DATABASE_URL = f"mysql+mysqldb://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}:{os.getenv('MYSQL_PORT')}/{os.getenv('MYSQL_DATABASE')}"
+# Sử dụng credentials từ docker-compose.yml, hoặc DATABASE_URL nếu được đặt
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL") or f"mysql+mysqldb://{os.getenv('MYSQL_USER')}:{os.getenv('MYSQL_PASSWORD')}@{os.getenv('MYSQL_HOST')}:{os.getenv('MYSQL_PORT')}/{os.getenv('MYSQL_DATABASE')}"
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+def _engine_options(url: str) -> Dict:
+    if url.startswith("sqlite"):
+        return {"connect_args": {"check_same_thread": False}}
+    # Giới hạn số kết nối để một đợt corrections không làm cạn connection của MySQL
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_pre_ping": True,
+    }
+
+ENGINE_OPTIONS = _engine_options(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, **ENGINE_OPTIONS)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
@@ -19,4 +34,57 @@ def get_db():
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+@contextmanager
+def session_scope():
+    """Session cho background job và broadcast: commit khi xong, rollback khi lỗi, luôn trả connection về pool"""
+    db = SessionLocal()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+def upsert_statement(db, table, key_columns: List[str], updates: Callable, values: Optional[Dict] = None,
+                     select=None):
+    """INSERT (VALUES hoặc SELECT) kèm cập nhật khi trùng khóa, theo dialect của session.
+
+    `updates(new)` trả về dict cột -> biểu thức, trong đó `new` là các cột của dòng vừa
+    insert (excluded / VALUES()).
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    elif dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        raise ValueError(f"Upsert is not supported on {dialect}")
+    stmt = insert(table)
+    stmt = stmt.from_select([c.name for c in select.selected_columns], select) if select is not None else stmt.values(**values)
+    if dialect == "mysql":
+        return stmt.on_duplicate_key_update(**updates(stmt.inserted))
+    return stmt.on_conflict_do_update(index_elements=key_columns, set_=updates(stmt.excluded))
+
+def get_pool_status() -> Dict:
+    pool = engine.pool
+    if not hasattr(pool, "size"):
+        return {"pool": type(pool).__name__}
+    size = pool.size()
+    checked_out = pool.checkedout()
+    # Pool không công khai max_overflow: dùng giá trị đã cấu hình (None = mặc định của SQLAlchemy, vd. sqlite)
+    max_overflow = ENGINE_OPTIONS.get("max_overflow")
+    return {
+        "pool": type(pool).__name__,
+        "size": size,
+        "max_overflow": max_overflow,
+        "checked_in": pool.checkedin(),
+        "checked_out": checked_out,
+        "overflow": pool.overflow(),
+        "utilization": checked_out / (size + max(max_overflow or 0, 0)) if size else 0.0
+    }
@@ -0,0 +1,121 @@
+import argparse
+import os
+import sys
+from typing import List
+
+import numpy as np
+
+from .inference_backends import (
+    DEFAULT_MODEL_PATH, ONNX_FILENAME, TORCHSCRIPT_FILENAME, OnnxBackend, TorchBackend, TorchScriptBackend,
+    load_hf_model, load_tokenizer, softmax
+)
+
+# Tập mẫu cố định để so sánh kết quả giữa PyTorch và graph đã export
+PARITY_SAMPLES = [
+    "This book was absolutely fantastic! The characters were great and the story was engaging throughout.",
+    "What a terrible waste of time. The plot made no sense and the writing was horrible.",
+    "One of the best novels I've read this year. Highly recommended!",
+    "I couldn't even finish it. The worst book ever.",
+    "The world building was amazing but the ending was a bit weak.",
+    "Great book!",
+    "Loved it",
+    "Not worth the price.",
+]
+
+
+def _logits_only(model):
+    """Bọc HF model để forward nhận tensor theo vị trí và chỉ trả về logits"""
+    import torch
+
+    class LogitsOnly(torch.nn.Module):
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, input_ids, attention_mask):
+            return self.inner(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    return LogitsOnly(model).eval()
+
+
+def export_onnx(model, encoded, output_path: str, opset: int = 14):
+    import torch
+
+    wrapper = _logits_only(model)
+    inputs = (torch.from_numpy(encoded["input_ids"]), torch.from_numpy(encoded["attention_mask"]))
+    options = dict(
+        input_names=["input_ids", "attention_mask"],
+        output_names=["logits"],
+        dynamic_axes={
+            "input_ids": {0: "batch", 1: "sequence"},
+            "attention_mask": {0: "batch", 1: "sequence"},
+            "logits": {0: "batch"},
+        },
+        opset_version=opset,
+    )
+    with torch.no_grad():
+        try:
+            torch.onnx.export(wrapper, inputs, output_path, dynamo=False, **options)
+        except TypeError:
+            # torch cũ chưa có tham số `dynamo`
+            torch.onnx.export(wrapper, inputs, output_path, **options)
+
+
+def export_torchscript(model, encoded, output_path: str):
+    import torch
+
+    wrapper = _logits_only(model)
+    inputs = (torch.from_numpy(encoded["input_ids"]), torch.from_numpy(encoded["attention_mask"]))
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, inputs)
+    traced.save(output_path)
+
+
+def check_parity(reference, candidate, tokenizer, samples: List[str], tolerance: float) -> bool:
+    """So sánh xác suất và nhãn của backend đã export với PyTorch trên tập mẫu cố định"""
+    encoded = tokenizer(samples, padding=True, truncation=True, return_tensors="np")
+    expected = softmax(reference.predict_logits(encoded))
+    actual = softmax(candidate.predict_logits(encoded))
+    max_diff = float(np.abs(expected - actual).max())
+    labels_match = bool((expected.argmax(axis=-1) == actual.argmax(axis=-1)).all())
+    ok = max_diff <= tolerance and labels_match
+    print(f"[{candidate.name}] max |p_torch - p_{candidate.name}| = {max_diff:.2e}, "
+          f"labels match: {labels_match} -> {'OK' if ok else 'FAILED'}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the sentiment classifier to ONNX and/or TorchScript")
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--format", choices=["onnx", "torchscript", "all"], default="all")
+    parser.add_argument("--output-dir", help="Where to write the exported graph (default: the checkpoint directory)")
+    parser.add_argument("--opset", type=int, default=14)
+    parser.add_argument("--tolerance", type=float, default=1e-4, help="Max allowed probability difference")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or args.model_path
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = load_tokenizer()
+    model = load_hf_model(args.model_path)
+    reference = TorchBackend(model)
+    encoded = tokenizer(PARITY_SAMPLES[:2], padding=True, truncation=True, return_tensors="np")
+
+    ok = True
+    if args.format in ("onnx", "all"):
+        path = os.path.join(output_dir, ONNX_FILENAME)
+        export_onnx(model, encoded, path, opset=args.opset)
+        print(f"Exported ONNX model to {path}")
+        ok &= check_parity(reference, OnnxBackend(path), tokenizer, PARITY_SAMPLES, args.tolerance)
+    if args.format in ("torchscript", "all"):
+        path = os.path.join(output_dir, TORCHSCRIPT_FILENAME)
+        export_torchscript(model, encoded, path)
+        print(f"Exported TorchScript model to {path}")
+        ok &= check_parity(reference, TorchScriptBackend(path), tokenizer, PARITY_SAMPLES, args.tolerance)
+
+    if not ok:
+        print("Parity check failed, do not serve the exported model")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+
+import numpy as np
+
+# Tên model gốc của tokenizer và config, checkpoint chỉ chứa trọng số đã fine-tune
+BASE_MODEL_NAME = "distilbert-base-uncased"
+ONNX_FILENAME = "model.onnx"
+TORCHSCRIPT_FILENAME = "model.torchscript.pt"
+INT8_TORCHSCRIPT_FILENAME = "model.int8.torchscript.pt"
+# Checkpoint mặc định của service và các CLI export/quantize
+DEFAULT_MODEL_PATH = "model/my-imdb-sentiment-model/checkpoint-2343"
+
+
+def configure_torch_threads():
+    """Đặt số thread intra-op / inter-op của torch từ biến môi trường (0 = mặc định của torch)"""
+    import torch
+
+    intra_op = int(os.getenv("INFERENCE_INTRA_OP_THREADS", "0"))
+    inter_op = int(os.getenv("INFERENCE_INTER_OP_THREADS", "0"))
+    if intra_op > 0:
+        torch.set_num_threads(intra_op)
+    if inter_op > 0:
+        try:
+            torch.set_num_interop_threads(inter_op)
+        except RuntimeError:
+            # Chỉ đặt được trước khi torch chạy tác vụ song song đầu tiên
+            pass
+
+
+def import_inference_libraries(backend_name: str):
+    """Import các thư viện nặng mà backend cần, tách riêng để đo thời gian khởi động"""
+    import transformers  # noqa: F401  (tokenizer)
+
+    if backend_name == "onnx":
+        import onnxruntime  # noqa: F401
+    else:
+        import torch  # noqa: F401
+
+
+def load_tokenizer():
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(BASE_MODEL_NAME)
+
+
+def load_hf_model(model_path: str):
+    """Nạp DistilBERT classifier đã fine-tune từ checkpoint, ở chế độ eval"""
+    from transformers import AutoModelForSequenceClassification, DistilBertConfig
+
+    config = DistilBertConfig.from_pretrained(BASE_MODEL_NAME, num_labels=2)
+    model = AutoModelForSequenceClassification.from_pretrained(
+        model_path,
+        config=config,
+        local_files_only=True,
+        ignore_mismatched_sizes=True
+    )
+    model.eval()
+    return model
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=-1, keepdims=True)
+
+
+class InferenceBackend(ABC):
+    """Chạy forward pass trên batch đã tokenize (numpy int64), trả về logits dạng numpy"""
+
+    name = "base"
+
+    @abstractmethod
+    def predict_logits(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        ...
+
+
+class TorchBackend(InferenceBackend):
+    name = "torch"
+
+    def __init__(self, model):
+        self.model = model
+
+    def predict_logits(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            logits = self.model(
+                input_ids=torch.from_numpy(encoded["input_ids"]),
+                attention_mask=torch.from_numpy(encoded["attention_mask"])
+            ).logits
+        return logits.numpy()
+
+
+class TorchScriptBackend(InferenceBackend):
+    name = "torchscript"
+
+    def __init__(self, path: str):
+        import torch
+
+        self.model = torch.jit.load(path, map_location="cpu")
+        self.model.eval()
+
+    def predict_logits(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        import torch
+
+        with torch.no_grad():
+            logits = self.model(torch.from_numpy(encoded["input_ids"]), torch.from_numpy(encoded["attention_mask"]))
+        return logits.numpy()
+
+
+class QuantizedTorchBackend(TorchScriptBackend):
+    """Bản dynamic-int8 (Linear layers) do `python -m app.quantize` tạo ra và đã qua accuracy gate"""
+
+    name = "torch-int8"
+
+
+class OnnxBackend(InferenceBackend):
+    name = "onnx"
+
+    def __init__(self, path: str, intra_op_threads: Optional[int] = None):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("onnxruntime is not installed, cannot use the onnx backend")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        # Session có thread pool riêng nên model shadow có thể được giới hạn thread
+        if intra_op_threads is None:
+            intra_op_threads = int(os.getenv("INFERENCE_INTRA_OP_THREADS", "0"))
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = int(os.getenv("INFERENCE_INTER_OP_THREADS", "0"))
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+
+    def predict_logits(self, encoded: Dict[str, np.ndarray]) -> np.ndarray:
+        return self.session.run(["logits"], {
+            "input_ids": encoded["input_ids"].astype(np.int64),
+            "attention_mask": encoded["attention_mask"].astype(np.int64)
+        })[0]
+
+
+def load_backend(name: str, model_path: str, intra_op_threads: Optional[int] = None) -> InferenceBackend:
+    """Nạp backend theo tên; onnx/torchscript/torch-int8 đọc file đã export nằm cạnh checkpoint.
+
+    `intra_op_threads` chỉ áp dụng cho onnx: thread pool của torch là toàn cục cho cả
+    process nên không thể giới hạn riêng cho một model.
+    """
+    if intra_op_threads is not None and name != "onnx":
+        raise ValueError(f"intra_op_threads is only supported by the onnx backend, not {name}")
+    if name == "torch":
+        configure_torch_threads()
+        return TorchBackend(load_hf_model(model_path))
+    if name == "torchscript":
+        configure_torch_threads()
+        return TorchScriptBackend(os.path.join(model_path, TORCHSCRIPT_FILENAME))
+    if name == "torch-int8":
+        configure_torch_threads()
+        return QuantizedTorchBackend(os.path.join(model_path, INT8_TORCHSCRIPT_FILENAME))
+    if name == "onnx":
+        return OnnxBackend(os.path.join(model_path, ONNX_FILENAME), intra_op_threads)
+    raise ValueError(f"Unknown inference backend: {name}")
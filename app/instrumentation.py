@@ -0,0 +1,180 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Bucket mặc định (giây) cho latency từ dưới 1ms tới vài giây
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count", "_lock")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # phần tử cuối là +Inf
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram:
+    """Histogram kiểu Prometheus: mỗi observe chỉ là một bisect và vài phép cộng dưới lock"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._children: Dict[Tuple[str, ...], _HistogramChild] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = _HistogramChild(self.buckets)
+
+    def labels(self, **labels) -> _HistogramChild:
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, _HistogramChild(self.buckets))
+        return child
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, child in list(self._children.items()):
+            labels = dict(zip(self.labelnames, key))
+            with child._lock:
+                counts, total, count = list(child.counts), child.sum, child.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=_format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {repr(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Gauge:
+    """Gauge đọc giá trị qua callback lúc scrape, không tốn gì trên đường xử lý request.
+
+    Callback trả về một số, hoặc dict {tuple giá trị label: số} khi gauge có label.
+    """
+
+    def __init__(self, name: str, documentation: str,
+                 callback: Callable[[], Union[float, Dict[Tuple[str, ...], float]]],
+                 labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.callback()
+        except Exception as e:
+            print(f"Error collecting gauge {self.name}: {e}")
+            return lines
+        if isinstance(value, dict):
+            for key, sample in value.items():
+                labels = dict(zip(self.labelnames, key if isinstance(key, tuple) else (key,)))
+                lines.append(f"{self.name}{_format_labels(labels)} {_format_value(sample)}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Union[Histogram, Gauge]] = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, callback, labelnames))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+TOKENIZATION_SECONDS = registry.histogram(
+    "sentiment_tokenization_seconds", "Time to tokenize and truncate one inference batch")
+FORWARD_PASS_SECONDS = registry.histogram(
+    "sentiment_forward_pass_seconds", "Model forward pass time per length bucket", ["bucket"])
+DB_COMMIT_SECONDS = registry.histogram(
+    "db_commit_seconds", "SQLAlchemy session commit time (flush + COMMIT)")
+WS_BROADCAST_SECONDS = registry.histogram(
+    "websocket_broadcast_seconds", "Time to serialize and fan out one message to local WebSocket clients", ["type"])
+COMMENT_CREATE_SECONDS = registry.histogram(
+    "comment_create_seconds", "End-to-end POST /books/{id}/comments handling time", ["mode", "status"])
+
+
+def _before_commit(session: Session):
+    session.info["commit_started"] = time.perf_counter()
+
+
+def _after_commit(session: Session):
+    started = session.info.pop("commit_started", None)
+    if started is not None:
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+
+
+def instrument_db_commits():
+    """Đo thời gian commit của mọi Session (gồm cả flush) qua event của SQLAlchemy"""
+    if not event.contains(Session, "before_commit", _before_commit):
+        event.listen(Session, "before_commit", _before_commit)
+        event.listen(Session, "after_commit", _after_commit)
@@ -0,0 +1,51 @@
+import fcntl
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Dict
+
+# Các worker uvicorn trên cùng máy phải dùng chung thư mục này
+LEADER_LOCK_DIR = os.getenv("LEADER_LOCK_DIR", tempfile.gettempdir())
+
+_held: Dict[str, int] = {}
+
+
+def try_lock(path: str) -> bool:
+    """Giữ flock không chặn trên `path` tới khi `unlock` hoặc process chết.
+
+    Chỉ một process giữ được lock tại một thời điểm; khi process đó chết, kernel giải
+    phóng lock và process khác lấy được ở lần thử tiếp theo. Gọi lại khi đã giữ lock
+    trả về True.
+    """
+    if path in _held:
+        return True
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+    _held[path] = fd
+    return True
+
+
+def unlock(path: str):
+    fd = _held.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+
+
+def is_leader(role: str) -> bool:
+    """True nếu process hiện tại là process duy nhất (trong các worker) đảm nhận `role`"""
+    return try_lock(os.path.join(LEADER_LOCK_DIR, f"sentiment-{role}.lock"))
+
+
+@contextmanager
+def exclusive(role: str):
+    """Chờ tới khi giữ được lock của `role`, giải phóng khi ra khỏi block"""
+    fd = os.open(os.path.join(LEADER_LOCK_DIR, f"sentiment-{role}.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
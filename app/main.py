@@ -1,7 +1,8 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, WebSocket, WebSocketDisconnect, Response, Query, Header
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict
+from typing import List, Dict, Optional
 from sqlalchemy.orm import Session
 from . import crud, models, database
 from .database import engine, get_db
@@ -12,8 +13,21 @@ from pathlib import Path
 from .websocket_manager import manager
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
 from starlette.websockets import WebSocketState
+from .metrics_aggregator import metrics_aggregator
+from .dashboard_cache import dashboard_cache
 from .metrics_service import MetricsService
-from datetime import datetime
+from .prediction_log_writer import prediction_log_writer
+from . import metrics_rollups
+from .batching import InferenceQueueFull
+from .manage import prepare_database
+from .bulk_scoring import BulkScorer, detect_format, read_records
+from . import instrumentation
+from .instrumentation import COMMENT_CREATE_SECONDS
+from starlette.concurrency import run_in_threadpool
+import hmac
+import io
+import time
+from datetime import datetime, timedelta, timezone
 import logging
 
 # Cấu hình logging
@@ -23,10 +37,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-models.Base.metadata.create_all(bind=engine)
+# Tắt (DB_PREPARE_ON_STARTUP=0) khi deploy chạy `python -m app.manage migrate` như một bước riêng
+if os.getenv("DB_PREPARE_ON_STARTUP", "1") == "1":
+    prepare_database()
+instrumentation.instrument_db_commits()
 
 app = FastAPI(title="Bookstore API")
 
+# "sync": chờ chấm điểm xong mới trả về; "async": trả 202 ngay sau khi insert
+COMMENT_SCORING_MODE = os.getenv("COMMENT_SCORING_MODE", "sync")
+# "background": nạp model ở thread nền khi khởi động; "lazy": nạp khi có request chấm điểm đầu tiên.
+# Ở chế độ lazy /readyz báo sẵn sàng trước khi model được nạp (nếu không, orchestrator chặn traffic
+# theo readiness sẽ không bao giờ gửi request đầu tiên); request đầu tiên chịu thời gian nạp model.
+SENTIMENT_LOAD_MODE = os.getenv("SENTIMENT_LOAD_MODE", "background")
+
+@app.on_event("startup")
+async def start_background_workers():
+    if SENTIMENT_LOAD_MODE == "background":
+        crud.sentiment_analyzer.start_loading()
+    await manager.start()
+    await crud.scoring_queue.start()
+    await prediction_log_writer.start()
+    await crud.sentiment_analyzer.shadow.log_writer.start()
+    await metrics_aggregator.start()
+    await dashboard_cache.start()
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    await crud.scoring_queue.stop()
+    # Sau scoring queue để các prediction cuối cùng cũng được ghi
+    await prediction_log_writer.stop()
+    await crud.sentiment_analyzer.shadow.log_writer.stop()
+    await metrics_aggregator.stop()
+    await dashboard_cache.stop()
+    await manager.stop()
+
 # Cấu hình CORS
 origins = [
     "http://localhost:3000",
@@ -39,6 +84,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Frontend khác origin chỉ đọc được header không thuộc danh sách mặc định khi được expose
+    expose_headers=["X-Next-Cursor", "ETag"],
 )
 
 # Cấu hình trusted hosts
@@ -60,10 +107,44 @@ class SentimentUpdate(BaseModel):
     id: str
     sentiment: str
 
+class ShadowConfig(BaseModel):
+    version: Optional[str] = None
+    sample_rate: Optional[float] = None
+
+# API quản trị model (nạp checkpoint, đổi model, cấu hình shadow) chỉ bật khi đặt MODEL_ADMIN_TOKEN;
+# client gửi token trong header X-Admin-Token
+MODEL_ADMIN_TOKEN = os.getenv("MODEL_ADMIN_TOKEN", "")
+# from_pretrained/torch.jit.load dùng pickle nên chỉ nạp checkpoint nằm trong thư mục này
+SENTIMENT_MODELS_DIR = os.path.realpath(os.getenv("SENTIMENT_MODELS_DIR", "model"))
+
+def require_model_admin(x_admin_token: Optional[str] = Header(None)):
+    if not MODEL_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Model admin API is disabled, set MODEL_ADMIN_TOKEN to enable it")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, MODEL_ADMIN_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid admin token")
+
+def resolve_model_path(model_path: str) -> str:
+    resolved = os.path.realpath(model_path)
+    if os.path.commonpath([resolved, SENTIMENT_MODELS_DIR]) != SENTIMENT_MODELS_DIR:
+        raise HTTPException(status_code=400, detail=f"model_path must be inside {SENTIMENT_MODELS_DIR}")
+    return resolved
+
+class ModelLoadRequest(BaseModel):
+    version: str
+    model_path: str
+    backend: Optional[str] = None
+    # Thread pool riêng cho model (chỉ backend onnx), dùng cho model ứng viên của shadow
+    intra_op_threads: Optional[int] = None
+    activate: bool = False
+
 @app.get("/books", response_model=List[models.Book])
 def list_books(db: Session = Depends(database.get_db)):
     return crud.get_books(db)
 
+@app.get("/books/summary", response_model=List[models.BookSummary])
+def list_books_summary(db: Session = Depends(database.get_db)):
+    return crud.get_books_summary(db)
+
 @app.get("/books/{book_id}", response_model=models.Book)
 def get_book(book_id: str, db: Session = Depends(database.get_db)):
     book = crud.get_book(db, book_id)
@@ -75,25 +156,62 @@ def get_book(book_id: str, db: Session = Depends(database.get_db)):
 async def create_comment(
     book_id: str,
     comment: CommentCreate,
+    response: Response,
+    scoring: str = None,
     db: Session = Depends(database.get_db)
 ):
+    background = (scoring or COMMENT_SCORING_MODE) == "async"
+    started = time.perf_counter()
+    status = 500
     try:
         new_comment = await crud.create_comment(
             db,
             book_id=book_id,
             user_id=comment.user_id,
             user_name=comment.user_name,
-            content=comment.content
+            content=comment.content,
+            background=background
         )
+        if background:
+            response.status_code = 202
+        status = response.status_code or 200
         return new_comment
+    except InferenceQueueFull as e:
+        status = 429
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        COMMENT_CREATE_SECONDS.labels(mode="async" if background else "sync", status=status)\
+            .observe(time.perf_counter() - started)
+
+@app.post("/comments/bulk")
+async def bulk_score_comments(
+    file: UploadFile = File(...),
+    book_id: str = None,
+    offset: int = 0,
+    format: str = None,
+    db: Session = Depends(database.get_db)
+):
+    """Chấm điểm hàng loạt review từ file JSONL/CSV, trả về offset để resume nếu bị ngắt"""
+    fmt = format or detect_format(file.filename or "")
+    if fmt not in ("jsonl", "csv"):
+        raise HTTPException(status_code=400, detail="Format must be jsonl or csv")
+    stream = io.TextIOWrapper(file.file, encoding="utf-8", newline="")
+    scorer = BulkScorer(crud.sentiment_analyzer)
+    try:
+        return await run_in_threadpool(
+            scorer.run, db, read_records(stream, fmt),
+            default_book_id=book_id, start_offset=offset
+        )
+    except Exception as e:
+        # Trả về offset đã commit để client gọi lại với ?offset=...
+        raise HTTPException(status_code=500, detail={"error": str(e), "offset": scorer.committed_offset})
 
 @app.post("/books/{book_id}/upload-cover")
 async def upload_book_cover(book_id: str, file: UploadFile = File(...), db: Session = Depends(database.get_db)):
     # Kiểm tra book tồn tại
-    book = crud.get_book(db, book_id)
-    if not book:
+    if not crud.book_exists(db, book_id):
         raise HTTPException(status_code=404, detail="Book not found")
     
     # Kiểm tra file type
@@ -118,8 +236,7 @@ async def upload_book_cover(book_id: str, file: UploadFile = File(...), db: Sess
 # Endpoint lấy thống kê sentiment
 @app.get("/books/{book_id}/sentiment-stats")
 def get_book_sentiment_stats(book_id: str, db: Session = Depends(database.get_db)):
-    book = crud.get_book(db, book_id)
-    if not book:
+    if not crud.book_exists(db, book_id):
         raise HTTPException(status_code=404, detail="Book not found")
     return crud.get_sentiment_stats(db, book_id)
 
@@ -132,12 +249,21 @@ def get_overall_sentiment_stats(db: Session = Depends(database.get_db)):
 @app.get("/books/{book_id}/comments-with-sentiment", response_model=List[models.Comment])
 def get_book_comments_with_sentiment(
     book_id: str, 
+    response: Response,
     sentiment: str = None,
+    limit: int = Query(100, ge=1, le=500),
+    cursor: str = None,
     db: Session = Depends(database.get_db)
 ):
-    comments = crud.get_book_comments(db, book_id)
-    if sentiment:
-        comments = [c for c in comments if c.sentiment == sentiment]
+    """Trả về một trang comments; cursor của trang tiếp theo nằm trong header X-Next-Cursor"""
+    try:
+        comments, next_cursor = crud.get_book_comments_page(
+            db, book_id, sentiment=sentiment, limit=limit, cursor=cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
     return comments
 
 # Thêm WebSocket endpoints
@@ -162,6 +288,9 @@ async def websocket_endpoint(websocket: WebSocket):
                         data["data"]["id"],
                         data["data"]["sentiment"]
                     )
+                elif data.get("type") == "subscribe":
+                    # {"type": "subscribe", "books": [...], "types": [...]}, bỏ trống để nhận tất cả
+                    manager.subscribe(websocket, books=data.get("books"), types=data.get("types"))
             except WebSocketDisconnect:
                 print("Client disconnected normally")
                 break
@@ -180,25 +309,196 @@ async def update_comment_sentiment(
     update: SentimentUpdate,
     db: Session = Depends(database.get_db)
 ):
-    comment = crud.update_comment_sentiment(db, comment_id, update.sentiment)
+    def apply_correction():
+        previous_sentiment = crud.get_comment_sentiment(db, comment_id)
+        comment = crud.update_comment_sentiment(db, comment_id, update.sentiment)
+        if not comment:
+            return None
+        # Ghi nhận correction ở đây, không phụ thuộc việc có WebSocket client hay không
+        crud.sentiment_analyzer.shadow.record_correction(db, comment_id, update.sentiment)
+        try:
+            # Cập nhật accuracy; prediction sai được lưu vào correction store làm dữ liệu training
+            MetricsService(db).log_sentiment_correction(comment_id, update.sentiment, previous_sentiment)
+        except Exception as e:
+            print(f"Error logging sentiment correction: {e}")
+        return comment
+
+    # Query DB và correction store (sqlite, có thể chờ lock tới 30s) chạy ở threadpool
+    comment = await run_in_threadpool(apply_correction)
     if not comment:
         raise HTTPException(status_code=404, detail="Comment not found")
-    
+
     # Broadcast update through WebSocket
     await manager.broadcast_sentiment_update(comment_id, update.sentiment)
     
     return comment
 
+@app.get("/api/db/pool")
+def get_db_pool_status():
+    return database.get_pool_status()
+
+def _db_pool_samples():
+    status = database.get_pool_status()
+    return {
+        (key,): value for key, value in status.items()
+        if key in ("size", "checked_in", "checked_out", "overflow")
+    }
+
+instrumentation.registry.gauge(
+    "sentiment_inference_queue_depth", "Requests waiting in the primary inference micro-batcher",
+    lambda: crud.sentiment_analyzer.batcher.queue_depth)
+instrumentation.registry.gauge(
+    "sentiment_shadow_queue_depth", "Requests waiting for the shadow model",
+    lambda: crud.sentiment_analyzer.shadow.batcher.queue_depth)
+instrumentation.registry.gauge(
+    "sentiment_scoring_queue_depth", "Comments waiting for background scoring",
+    lambda: crud.scoring_queue.depth)
+instrumentation.registry.gauge(
+    "prediction_log_buffer_depth", "Prediction log rows waiting to be written to the database",
+    lambda: prediction_log_writer.depth)
+instrumentation.registry.gauge(
+    "prediction_log_dropped", "Prediction log rows dropped by the overflow policy or after failed writes",
+    lambda: prediction_log_writer.dropped)
+instrumentation.registry.gauge(
+    "prediction_log_rejected", "Prediction log rows the database refused (constraint or data errors)",
+    lambda: prediction_log_writer.rejected)
+instrumentation.registry.gauge(
+    "sentiment_model_ready", "1 when the active sentiment model is loaded and warmed up",
+    lambda: 1 if crud.sentiment_analyzer.is_ready else 0)
+instrumentation.registry.gauge(
+    "websocket_active_connections", "WebSocket clients connected to this worker",
+    lambda: len(manager.active_connections))
+instrumentation.registry.gauge(
+    "db_pool_connections", "SQLAlchemy connection pool usage", _db_pool_samples, ["state"])
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(instrumentation.registry.render(), media_type=instrumentation.CONTENT_TYPE)
+
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz(response: Response):
+    """503 cho tới khi model nạp xong; ở chế độ lazy chỉ 503 khi nạp model bị lỗi"""
+    analyzer = crud.sentiment_analyzer
+    ready = analyzer.is_ready or (SENTIMENT_LOAD_MODE == "lazy" and analyzer.state != "failed")
+    if not ready:
+        response.status_code = 503
+    return {
+        "status": "ready" if ready else analyzer.state,
+        "model_state": analyzer.state,
+        "load_mode": SENTIMENT_LOAD_MODE,
+        "backend": analyzer.backend_name,
+        "active_model": analyzer.registry.active.version if analyzer.registry.active else None,
+        "error": analyzer.load_error,
+        "startup_timings": analyzer.startup_timings,
+        "queued_requests": analyzer.batcher.queue_depth
+    }
+
+@app.get("/api/models")
+def list_models():
+    return crud.sentiment_analyzer.registry.list()
+
+@app.post("/api/models", dependencies=[Depends(require_model_admin)])
+async def load_model(request: ModelLoadRequest):
+    """Nạp checkpoint mới và warm-up ở threadpool; tuỳ chọn chuyển sang phục vụ ngay"""
+    analyzer = crud.sentiment_analyzer
+    model_path = resolve_model_path(request.model_path)
+    try:
+        info = await run_in_threadpool(analyzer.load_model, request.version, model_path, request.backend,
+                                       None, request.intra_op_threads)
+        if request.activate:
+            info = await run_in_threadpool(analyzer.activate_model, request.version)
+        return info
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except RuntimeError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+@app.post("/api/models/{version}/activate", dependencies=[Depends(require_model_admin)])
+async def activate_model(version: str):
+    try:
+        return await run_in_threadpool(crud.sentiment_analyzer.activate_model, version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Model version {version} is not loaded")
+
+@app.delete("/api/models/{version}", dependencies=[Depends(require_model_admin)])
+def unload_model(version: str):
+    if version == crud.sentiment_analyzer.shadow.candidate_version:
+        raise HTTPException(status_code=409, detail=f"Model version {version} is the shadow candidate")
+    try:
+        crud.sentiment_analyzer.registry.unload(version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Model version {version} is not loaded")
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return {"status": "unloaded", "version": version}
+
+@app.get("/api/shadow")
+def get_shadow_stats(db: Session = Depends(database.get_db)):
+    return crud.sentiment_analyzer.shadow.stats(db)
+
+@app.put("/api/shadow", dependencies=[Depends(require_model_admin)])
+def configure_shadow(config: ShadowConfig, db: Session = Depends(database.get_db)):
+    """Chọn model ứng viên (đã nạp qua /api/models) và tỉ lệ lấy mẫu; version null để tắt"""
+    try:
+        crud.sentiment_analyzer.shadow.configure(config.version, config.sample_rate)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return crud.sentiment_analyzer.shadow.stats(db)
+
+@app.get("/api/cache/stats")
+def get_prediction_cache_stats():
+    return crud.sentiment_analyzer.cache.stats()
+
+@app.get("/api/tokenization/stats")
+def get_tokenization_stats():
+    tokenization = crud.sentiment_analyzer.tokenization
+    if tokenization is None:
+        raise HTTPException(status_code=503, detail="Sentiment model is not loaded")
+    return tokenization.stats()
+
+def _as_utc(moment: datetime) -> datetime:
+    # Cột DateTime lưu giờ UTC không kèm timezone
+    return moment.astimezone(timezone.utc).replace(tzinfo=None) if moment.tzinfo else moment
+
+@app.get("/api/metrics/series")
+def get_metrics_series(
+    start: datetime = None,
+    end: datetime = None,
+    resolution: str = Query(None, pattern="^(1m|1h|1d)$"),
+    db: Session = Depends(get_db)
+):
+    """Accuracy, số prediction và latency theo thời gian từ bảng rollup (mặc định: 1 giờ gần nhất)"""
+    end = _as_utc(end) if end else datetime.utcnow()
+    start = _as_utc(start) if start else end - timedelta(hours=1)
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+    try:
+        return metrics_rollups.get_series(db, start, end, resolution)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/dashboard/metrics")
-async def get_dashboard_metrics(db: Session = Depends(get_db)):
+async def get_dashboard_metrics(if_none_match: Optional[str] = Header(None)):
+    """Snapshot tính sẵn bởi dashboard_cache; trả 304 nếu client đã có bản mới nhất"""
     try:
-        metrics_service = MetricsService(db)
-        metrics = metrics_service.get_dashboard_metrics()
-        if not metrics:
+        body, etag = dashboard_cache.snapshot
+        if body is None:
+            body, etag = await run_in_threadpool(dashboard_cache.get)
+        if body is None:
             logger.error("Failed to get metrics")
             raise HTTPException(status_code=500, detail="Failed to get metrics")
-        logger.info("Successfully retrieved metrics")
-        return {"success": True, "data": metrics}
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+            return Response(status_code=304, headers=headers)
+        return Response(content=body, media_type="application/json", headers=headers)
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error in dashboard metrics endpoint: {e}")
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
@@ -0,0 +1,39 @@
+import argparse
+
+from . import leader, models
+from .database import engine, session_scope
+from .migrations import run_migrations
+
+
+def prepare_database(rebuild_summary: bool = False):
+    """Tạo bảng, chạy migration và khi được yêu cầu thì tính lại bảng tổng hợp sentiment.
+
+    Chạy dưới lock độc quyền giữa các worker trên cùng máy: worker khởi động cùng lúc
+    chờ nhau thay vì cùng chạy DDL, worker sau chỉ thấy mọi thứ đã xong. Bảng tổng hợp
+    được tính lần đầu bởi một migration; rebuild toàn bộ chỉ chạy khi gọi
+    `python -m app.manage rebuild-summary`, không phải mỗi lần worker khởi động:
+    INSERT ... SELECT GROUP BY chạy song song với comment mới sẽ khoá bảng comments
+    (InnoDB) hoặc ghi đè phần cộng dồn của worker khác.
+    """
+    with leader.exclusive("schema"):
+        models.Base.metadata.create_all(bind=engine)
+        run_migrations(engine)
+        if rebuild_summary:
+            from .crud import rebuild_sentiment_summary
+
+            with session_scope() as db:
+                rebuild_sentiment_summary(db)
+            print("Rebuilt book sentiment summary")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database maintenance for the bookstore API")
+    parser.add_argument("command", choices=["migrate", "rebuild-summary"],
+                        help="migrate: create tables and apply migrations; "
+                             "rebuild-summary: also recompute book_sentiment_summary from comments")
+    args = parser.parse_args()
+    prepare_database(rebuild_summary=args.command == "rebuild-summary")
+
+
+if __name__ == "__main__":
+    main()
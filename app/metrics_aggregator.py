@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy.orm import Session
+
+from . import metrics_rollups
+from .database import session_scope
+
+
+class RollingMetricsAggregator:
+    """Gom metrics của model theo phút trong bộ nhớ, cập nhật O(1) cho mỗi prediction.
+
+    Theo chu kỳ `flush_interval`, phần thay đổi của từng phút kể từ lần flush trước
+    được cộng dồn vào `metrics_rollups` (1m/1h/1d). Chỉ ghi phép cộng, không ghi giá trị
+    tuyệt đối, nên nhiều worker và worker khởi động lại trong cùng một phút không ghi
+    đè số liệu của nhau.
+
+    Snapshot cửa sổ trượt `window_seconds` được đọc lại từ các bucket 1m đã flush của
+    mọi worker, không từ bộ nhớ của worker hiện tại; dữ liệu trễ tối đa `flush_interval`.
+    """
+
+    def __init__(self, window_seconds: Optional[float] = None, flush_interval: Optional[float] = None):
+        self.window_seconds = window_seconds or float(os.getenv("METRICS_WINDOW_S", "3600"))
+        self.flush_interval = flush_interval or float(os.getenv("METRICS_FLUSH_INTERVAL_S", "5"))
+        self.retention_interval = float(os.getenv("METRICS_RETENTION_INTERVAL_S", "3600"))
+        self._last_retention = 0.0
+        self._lock = threading.Lock()
+        # Thay đổi theo phút (UTC) chưa được cộng vào metrics_rollups
+        self._deltas: Dict[datetime, Dict] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def _delta(self, at: datetime) -> Dict:
+        minute = metrics_rollups.floor_time(at, "1m")
+        delta = self._deltas.get(minute)
+        if delta is None:
+            delta = self._deltas[minute] = metrics_rollups.empty_delta()
+        return delta
+
+    def record_prediction(self, prediction: str, confidence: float, response_time: float,
+                          at: Optional[datetime] = None):
+        """`at` là timestamp của PredictionLog tương ứng, để correction tìm đúng bucket"""
+        positive = prediction.lower() == "positive"
+        with self._lock:
+            metrics_rollups.merge_delta(self._delta(at or datetime.utcnow()), {
+                "total": 1,
+                "positive": 1 if positive else 0,
+                "negative": 0 if positive else 1,
+                # Sentiment của comment mặc định là kết quả dự đoán nên được tính là đúng
+                "confirmed": 1,
+                "correct": 1,
+                "confidence_sum": confidence,
+                "confidence_min": confidence,
+                "confidence_max": confidence,
+                "response_time_sum": response_time
+            })
+
+    def record_correction(self, predicted_at: datetime, predicted: str,
+                          previous_sentiment: Optional[str], sentiment: str):
+        """Sửa số prediction đúng trong bucket của prediction, dù worker nào đã chấm điểm nó"""
+        predicted = predicted.lower()
+        was_correct = previous_sentiment is not None and predicted == previous_sentiment.lower()
+        is_correct = predicted == sentiment.lower()
+        if is_correct == was_correct:
+            return
+        with self._lock:
+            self._delta(predicted_at)["correct"] += 1 if is_correct else -1
+
+    def snapshot(self, db: Session, now: Optional[datetime] = None) -> Dict:
+        """Metrics của cửa sổ trượt, gộp từ metrics_rollups của mọi worker"""
+        now = now or datetime.utcnow()
+        return metrics_rollups.window_totals(db, now - timedelta(seconds=self.window_seconds), now)
+
+    def flush(self) -> bool:
+        """Cộng phần thay đổi chưa ghi vào metrics_rollups; trả về False nếu ghi lỗi"""
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        if not deltas and time.time() - self._last_retention <= self.retention_interval:
+            return True
+        try:
+            with session_scope() as db:
+                if deltas:
+                    metrics_rollups.add_minutes(db, deltas)
+                if time.time() - self._last_retention > self.retention_interval:
+                    deleted = metrics_rollups.apply_retention(db)
+                    self._last_retention = time.time()
+                    if any(deleted.values()):
+                        print(f"Metrics retention removed {deleted}")
+            return True
+        except Exception as e:
+            print(f"Error flushing rolling metrics: {e}")
+            # Transaction đã rollback: giữ lại phần thay đổi để cộng ở lần flush sau
+            with self._lock:
+                for minute, delta in deltas.items():
+                    metrics_rollups.merge_delta(self._delta(minute), delta)
+            return False
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.to_thread(self.flush)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+
+metrics_aggregator = RollingMetricsAggregator()
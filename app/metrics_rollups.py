@@ -0,0 +1,170 @@
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from .database import upsert_statement
+from .models import MetricsRollup, ModelMetrics
+
+RESOLUTIONS = {
+    "1m": timedelta(minutes=1),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+}
+COUNTERS = ("total", "positive", "negative", "confirmed", "correct", "confidence_sum", "response_time_sum")
+MAX_POINTS = 2000
+
+
+def retention() -> Dict[str, timedelta]:
+    return {
+        "1m": timedelta(hours=float(os.getenv("METRICS_RETENTION_1M_HOURS", "48"))),
+        "1h": timedelta(days=float(os.getenv("METRICS_RETENTION_1H_DAYS", "90"))),
+        "1d": timedelta(days=float(os.getenv("METRICS_RETENTION_1D_DAYS", "730"))),
+        # model_metrics chỉ còn các snapshot cũ và bản ghi của calculate_batch_metrics
+        "snapshots": timedelta(days=float(os.getenv("METRICS_SNAPSHOT_RETENTION_DAYS", "7"))),
+    }
+
+
+def floor_time(moment: datetime, resolution: str) -> datetime:
+    if resolution == "1m":
+        return moment.replace(second=0, microsecond=0)
+    if resolution == "1h":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def empty_delta() -> Dict:
+    delta = {column: 0 for column in COUNTERS}
+    delta["confidence_min"] = None
+    delta["confidence_max"] = None
+    return delta
+
+
+def merge_delta(into: Dict, delta: Dict) -> Dict:
+    for column in COUNTERS:
+        into[column] += delta[column]
+    for column, pick in (("confidence_min", min), ("confidence_max", max)):
+        if delta[column] is not None:
+            into[column] = delta[column] if into[column] is None else pick(into[column], delta[column])
+    return into
+
+
+def _increment_statement(db: Session, values: Dict):
+    """INSERT ... ON CONFLICT/DUPLICATE KEY cộng dồn counters và gộp min/max trong một câu lệnh"""
+    table = MetricsRollup.__table__
+    # min()/max() nhiều tham số của SQLite là hàm vô hướng, tương đương LEAST/GREATEST
+    if db.get_bind().dialect.name == "sqlite":
+        least, greatest = func.min, func.max
+    else:
+        least, greatest = func.least, func.greatest
+
+    def updates(new):
+        changes = {column: table.c[column] + new[column] for column in COUNTERS}
+        for column, pick in (("confidence_min", least), ("confidence_max", greatest)):
+            # LEAST/GREATEST trả NULL nếu một phía NULL
+            changes[column] = pick(func.coalesce(table.c[column], new[column]), func.coalesce(new[column], table.c[column]))
+        return changes
+
+    return upsert_statement(db, table, ["resolution", "bucket_start"], updates, values=values)
+
+
+def add_minutes(db: Session, minutes: Dict[datetime, Dict]):
+    """Cộng phần thay đổi của từng phút vào bucket 1m, 1h và 1d chứa nó.
+
+    Ghi bằng phép cộng trong DB (không phải giá trị tuyệt đối) nên nhiều worker cùng ghi
+    một phút, hoặc worker khởi động lại giữa phút, không ghi đè số liệu của nhau.
+    """
+    rows: Dict[tuple, Dict] = {}
+    for minute, delta in minutes.items():
+        for resolution in RESOLUTIONS:
+            key = (resolution, floor_time(minute, resolution))
+            merge_delta(rows.setdefault(key, empty_delta()), delta)
+    for (resolution, bucket_start), delta in sorted(rows.items()):
+        db.execute(_increment_statement(db, dict(delta, resolution=resolution, bucket_start=bucket_start)))
+
+
+def apply_retention(db: Session, now: Optional[datetime] = None) -> Dict[str, int]:
+    now = now or datetime.utcnow()
+    limits = retention()
+    deleted = {}
+    for resolution in RESOLUTIONS:
+        deleted[resolution] = db.query(MetricsRollup).filter(
+            MetricsRollup.resolution == resolution,
+            MetricsRollup.bucket_start < now - limits[resolution]
+        ).delete(synchronize_session=False)
+    deleted["snapshots"] = db.query(ModelMetrics).filter(
+        ModelMetrics.timestamp < now - limits["snapshots"]
+    ).delete(synchronize_session=False)
+    return deleted
+
+
+def window_totals(db: Session, start: datetime, end: datetime) -> Dict:
+    """Tổng các bucket 1m trong [start, end) của mọi worker, cùng dạng với ModelMetrics"""
+    table = MetricsRollup.__table__
+    row = db.query(
+        *[func.coalesce(func.sum(table.c[column]), 0) for column in COUNTERS],
+        func.min(table.c.confidence_min),
+        func.max(table.c.confidence_max),
+        func.max(table.c.bucket_start)
+    ).filter(
+        table.c.resolution == "1m",
+        table.c.bucket_start >= floor_time(start, "1m"),
+        table.c.bucket_start < end
+    ).one()
+    sums = dict(zip(COUNTERS, row[:len(COUNTERS)]))
+    confidence_min, confidence_max, latest_bucket = row[len(COUNTERS):]
+    total = int(sums["total"])
+    return {
+        "total_predictions": total,
+        "positive_count": int(sums["positive"]),
+        "negative_count": int(sums["negative"]),
+        "correct_predictions": int(sums["correct"]),
+        "accuracy": sums["correct"] / sums["confirmed"] if sums["confirmed"] else 0.0,
+        "avg_confidence": float(sums["confidence_sum"]) / total if total else 0.0,
+        "min_confidence": float(confidence_min) if confidence_min is not None else 0.0,
+        "max_confidence": float(confidence_max) if confidence_max is not None else 0.0,
+        "avg_response_time": float(sums["response_time_sum"]) / total if total else 0.0,
+        "latest_bucket": latest_bucket.isoformat() if latest_bucket else None
+    }
+
+
+def pick_resolution(start: datetime, end: datetime) -> str:
+    span = end - start
+    if span <= timedelta(hours=6):
+        return "1m"
+    if span <= timedelta(days=14):
+        return "1h"
+    return "1d"
+
+
+def get_series(db: Session, start: datetime, end: datetime, resolution: Optional[str] = None) -> Dict:
+    """Chuỗi accuracy, số lượng và latency theo từng bucket trong [start, end)"""
+    resolution = resolution or pick_resolution(start, end)
+    if resolution not in RESOLUTIONS:
+        raise ValueError(f"resolution must be one of {', '.join(RESOLUTIONS)}")
+    if (end - start) / RESOLUTIONS[resolution] > MAX_POINTS:
+        raise ValueError(f"Range too large for {resolution} resolution (max {MAX_POINTS} points)")
+
+    rows = db.query(MetricsRollup).filter(
+        MetricsRollup.resolution == resolution,
+        MetricsRollup.bucket_start >= floor_time(start, resolution),
+        MetricsRollup.bucket_start < end
+    ).order_by(MetricsRollup.bucket_start).all()
+    return {
+        "resolution": resolution,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "points": [{
+            "timestamp": row.bucket_start.isoformat(),
+            "total": row.total,
+            "positive": row.positive,
+            "negative": row.negative,
+            "accuracy": row.correct / row.confirmed if row.confirmed else None,
+            "avg_confidence": row.confidence_sum / row.total if row.total else None,
+            "min_confidence": row.confidence_min,
+            "max_confidence": row.confidence_max,
+            "avg_response_time": row.response_time_sum / row.total if row.total else None
+        } for row in rows]
+    }
@@ -3,11 +3,13 @@ import uuid
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 from .models import ModelMetrics, PredictionLog, CommentDB
+from .correction_store import get_correction_store
+from .prediction_log_writer import prediction_log_writer
+from .metrics_aggregator import metrics_aggregator
 import numpy as np
 import logging
-import csv
-import os
-from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict
 # Cấu hình logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,96 +21,42 @@ class MetricsService:
             db: SQLAlchemy Session object
         """
         self.db = db
-        # Thư mục chứa dữ liệu training
-        self.training_data_dir = "training_data"
-        os.makedirs(self.training_data_dir, exist_ok=True)
 
-    def _get_error_log_path(self) -> str:
-        """Tạo đường dẫn file log theo tháng hiện tại"""
-        current_month = datetime.utcnow().strftime('%Y%m')
-        return os.path.join(self.training_data_dir, f"sentiment_errors_{current_month}.csv")
+    def find_latest_prediction(self, comment_id: str):
+        """Prediction gần nhất của comment, ưu tiên dòng còn trong buffer chưa ghi xuống database"""
+        buffered = prediction_log_writer.find_latest(comment_id)
+        if buffered:
+            return SimpleNamespace(**buffered)
+        return self.db.query(PredictionLog).filter(
+            PredictionLog.comment_id == comment_id
+        ).order_by(
+            PredictionLog.timestamp.desc()
+        ).first()
 
-    def _ensure_error_log_exists(self, file_path: str):
-        """Đảm bảo file log tồn tại với headers"""
-        if not os.path.exists(file_path):
-            with open(file_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow([
-                    'timestamp',
-                    'text',
-                    'predicted_sentiment',
-                    'correct_sentiment',
-                    'confidence_score',
-                    'comment_id'
-                ])
-            logger.info(f"Created new error log file: {file_path}")
-
-    def _update_or_append_log(self, file_path: str, new_row: list, comment_id: str):
-        """Cập nhật hoặc thêm mới dữ liệu vào file log"""
+    def log_sentiment_correction(self, comment_id: str, correct_sentiment: str, previous_sentiment: str = None):
+        """Log khi người dùng sửa sentiment: cập nhật accuracy và lưu prediction sai làm dữ liệu training"""
         try:
-            # Đọc tất cả dữ liệu hiện tại
-            rows = []
-            found = False
-            
-            if os.path.exists(file_path):
-                with open(file_path, 'r', newline='', encoding='utf-8') as f:
-                    reader = csv.reader(f)
-                    header = next(reader)  # Lưu header
-                    for row in reader:
-                        if row[-1] == comment_id:  # comment_id là cột cuối
-                            rows.append(new_row)  # Thay thế bằng dữ liệu mới
-                            found = True
-                        else:
-                            rows.append(row)  # Giữ nguyên dữ liệu cũ
-            
-            # Nếu comment_id chưa tồn tại, thêm mới
-            if not found:
-                rows.append(new_row)
-            
-            # Ghi lại toàn bộ dữ liệu
-            with open(file_path, 'w', newline='', encoding='utf-8') as f:
-                writer = csv.writer(f)
-                writer.writerow(['timestamp', 'text', 'predicted_sentiment', 
-                               'correct_sentiment', 'confidence_score', 'comment_id'])  # Ghi header
-                writer.writerows(rows)  # Ghi dữ liệu
-                
-            logger.info(f"{'Updated' if found else 'Added new'} entry for comment {comment_id}")
-            
-        except Exception as e:
-            logger.error(f"Error updating log file: {str(e)}")
-            raise
-
-    def log_sentiment_correction(self, comment_id: str, correct_sentiment: str):
-        """Log khi người dùng sửa sentiment"""
-        try:
-            # Lấy prediction gần nhất từ database
-            prediction = self.db.query(PredictionLog).filter(
-                PredictionLog.comment_id == comment_id
-            ).order_by(
-                PredictionLog.timestamp.desc()
-            ).first()
+            prediction = self.find_latest_prediction(comment_id)
 
             if not prediction:
                 logger.error(f"No prediction found for comment {comment_id}")
                 return
 
+            # Accuracy dùng chung cho mọi worker, không phụ thuộc worker nào đã chấm điểm comment
+            metrics_aggregator.record_correction(
+                prediction.timestamp, prediction.predicted_sentiment, previous_sentiment, correct_sentiment
+            )
+
             # Chỉ log nếu dự đoán sai
             if prediction.predicted_sentiment.lower() != correct_sentiment.lower():
-                error_log_path = self._get_error_log_path()
-                self._ensure_error_log_exists(error_log_path)
-
-                # Chuẩn bị dữ liệu mới
-                new_row = [
-                    datetime.utcnow().isoformat(),
-                    prediction.text,
-                    prediction.predicted_sentiment,
-                    correct_sentiment,
-                    prediction.confidence_score,
-                    comment_id
-                ]
-
-                # Cập nhật hoặc thêm mới vào file log
-                self._update_or_append_log(error_log_path, new_row, comment_id)
+                # Upsert theo comment_id, không phải đọc lại toàn bộ file log
+                get_correction_store().upsert(
+                    comment_id=comment_id,
+                    text=prediction.text,
+                    predicted_sentiment=prediction.predicted_sentiment,
+                    correct_sentiment=correct_sentiment,
+                    confidence_score=prediction.confidence_score
+                )
 
         except Exception as e:
             logger.error(f"Error logging sentiment correction: {str(e)}")
@@ -117,23 +65,11 @@ class MetricsService:
     def get_training_data_stats(self):
         """Lấy thống kê về dữ liệu training"""
         try:
-            error_log_path = self._get_error_log_path()
-            if not os.path.exists(error_log_path):
-                return {
-                    "total_errors": 0,
-                    "current_month": datetime.utcnow().strftime('%Y-%m'),
-                    "file_path": error_log_path
-                }
-
-            with open(error_log_path, 'r', encoding='utf-8') as f:
-                reader = csv.reader(f)
-                next(reader)  # Skip header
-                errors = list(reader)
-
+            store = get_correction_store()
             return {
-                "total_errors": len(errors),
+                "total_errors": store.count(),
                 "current_month": datetime.utcnow().strftime('%Y-%m'),
-                "file_path": error_log_path
+                "file_path": store.path
             }
 
         except Exception as e:
@@ -141,8 +77,9 @@ class MetricsService:
             return None
 
     def log_prediction(self, text: str, prediction: str, confidence: float, 
-                      response_time: float, comment_id: str):
-        """Log một prediction riêng lẻ vào database
+                      response_time: float, comment_id: str, model_version: str = None,
+                      timestamp: datetime = None):
+        """Log một prediction riêng lẻ, được ghi xuống database theo lô ở background
         
         Args:
             text: Nội dung text cần phân tích
@@ -150,6 +87,8 @@ class MetricsService:
             confidence: Độ tin cậy của prediction (0-1)
             response_time: Thời gian phản hồi (ms)
             comment_id: ID của comment
+            model_version: Version của checkpoint đã tạo ra prediction
+            timestamp: Thời điểm prediction (UTC), mặc định là hiện tại
         """
         try:
             # Validate inputs
@@ -160,28 +99,20 @@ class MetricsService:
             if response_time < 0:
                 raise ValueError("Response time không được âm")
 
-            # Create log entry
-            log = PredictionLog(
-                id=str(uuid.uuid4()),
-                text=text,
-                predicted_sentiment=prediction.lower(),
-                confidence_score=confidence,
-                response_time=response_time,
-                comment_id=comment_id,
-                timestamp=datetime.utcnow()
-            )
-            
-            logger.info(f"Creating prediction log: comment_id={comment_id}, "
-                       f"prediction={prediction}, confidence={confidence:.2f}, "
-                       f"response_time={response_time:.2f}ms")
-            
-            self.db.add(log)
-            self.db.commit()
-            logger.info("Successfully committed to database")
-            
+            # Chỉ đưa vào buffer; prediction_log_writer ghi nhiều dòng một lần
+            prediction_log_writer.add({
+                "id": str(uuid.uuid4()),
+                "timestamp": timestamp or datetime.utcnow(),
+                "text": text[:1000],
+                "predicted_sentiment": prediction.lower(),
+                "confidence_score": confidence,
+                "response_time": response_time,
+                "comment_id": comment_id,
+                "model_version": model_version
+            })
+
         except Exception as e:
             logger.error(f"Error logging prediction - comment_id={comment_id}: {str(e)}")
-            self.db.rollback()
             raise
 
     def calculate_batch_metrics(self, time_window: timedelta = timedelta(hours=1)):
@@ -276,30 +207,15 @@ class MetricsService:
             self.db.rollback()
             return None
 
-    def get_dashboard_metrics(self):
-        """Lấy metrics cho dashboard"""
+    def get_dashboard_metrics(self, window_metrics: Dict):
+        """Lấy metrics cho dashboard
+
+        Args:
+            window_metrics: Tổng metrics của cửa sổ trượt từ metrics_rollups (chung cho mọi worker)
+        """
         try:
-            # Tạo metrics mới nếu chưa có
-            latest_metrics = self.db.query(ModelMetrics).order_by(
-                ModelMetrics.timestamp.desc()
-            ).first()
-            
-            # Log metrics object an toàn hơn
-            if latest_metrics:
-                logger.info("Latest metrics from database: %s", {
-                    'id': latest_metrics.id,
-                    'timestamp': latest_metrics.timestamp,
-                    'total_predictions': latest_metrics.total_predictions,
-                    'accuracy': latest_metrics.accuracy,
-                    'avg_response_time': latest_metrics.avg_response_time
-                })
-            else:
-                logger.info("No metrics found in database")
-            
-            if not latest_metrics:
-                logger.info("Calculating new batch metrics")
-                latest_metrics = self.calculate_batch_metrics()
-                
+            latest_metrics = SimpleNamespace(**window_metrics)
+
             # Lấy các corrections gần đây
             recent_corrections = (
                 self.db.query(CommentDB)
@@ -309,8 +225,6 @@ class MetricsService:
                 .all()
             )
             
-            logger.info(f"Found {len(recent_corrections)} recent corrections")
-            
             # Tính toán phân phối sentiment
             total_predictions = latest_metrics.total_predictions or 1
             positive_percentage = (latest_metrics.positive_count / total_predictions * 100) if total_predictions > 0 else 0
@@ -335,15 +249,8 @@ class MetricsService:
                 } for comment in recent_corrections]
             }
             
-            # Log response data an toàn hơn
-            logger.info("Returning dashboard data: %s", response_data)
             return response_data
             
         except Exception as e:
             logger.error("Error getting dashboard metrics: %s", str(e))
             return None 
-
-    def __del__(self):
-        """Cleanup database session when object is destroyed"""
-        if hasattr(self, 'db'):
-            self.db.close() 
\ No newline at end of file
@@ -0,0 +1,67 @@
+from datetime import datetime
+from typing import Callable, List, Tuple
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.orm import Session
+
+from .models import SchemaMigration
+
+
+def _create_index(conn: Connection, table: str, name: str, columns: List[str]):
+    existing = {index["name"] for index in inspect(conn).get_indexes(table)}
+    if name not in existing:
+        conn.execute(text(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})"))
+
+
+def _comment_filter_indexes(conn: Connection):
+    # Lọc theo sentiment rồi phân trang theo thời gian trong một sách
+    _create_index(conn, "comments", "ix_comments_book_sentiment_timestamp", ["book_id", "sentiment", "timestamp"])
+    # Phân trang khi không lọc sentiment
+    _create_index(conn, "comments", "ix_comments_book_timestamp", ["book_id", "timestamp", "id"])
+
+
+def _prediction_log_model_version(conn: Connection):
+    # Ghi lại checkpoint đã tạo ra mỗi prediction khi có nhiều model trong registry
+    columns = {column["name"] for column in inspect(conn).get_columns("prediction_logs")}
+    if "model_version" not in columns:
+        conn.execute(text("ALTER TABLE prediction_logs ADD COLUMN model_version VARCHAR(100)"))
+
+
+def _model_metrics_timestamp_index(conn: Connection):
+    # Truy vấn snapshot mới nhất và xoá snapshot hết hạn theo thời gian
+    _create_index(conn, "model_metrics", "ix_model_metrics_timestamp", ["timestamp"])
+
+
+def _backfill_book_sentiment_summary(conn: Connection):
+    # Tính bảng tổng hợp từ comments một lần; sau đó chỉ được cộng dồn theo từng comment.
+    # Sửa lệch số liệu bằng `python -m app.manage rebuild-summary`
+    from .crud import rebuild_sentiment_summary
+
+    with Session(bind=conn) as db:
+        rebuild_sentiment_summary(db)
+
+
+# Thêm migration mới vào cuối danh sách, không sửa hay đổi thứ tự các migration cũ
+MIGRATIONS: List[Tuple[str, Callable[[Connection], None]]] = [
+    ("0001_comment_filter_indexes", _comment_filter_indexes),
+    ("0002_prediction_log_model_version", _prediction_log_model_version),
+    ("0003_model_metrics_timestamp_index", _model_metrics_timestamp_index),
+    ("0004_backfill_book_sentiment_summary", _backfill_book_sentiment_summary),
+]
+
+
+def run_migrations(engine: Engine):
+    """Chạy các migration chưa được áp dụng, ghi lại version vào bảng schema_migrations"""
+    with engine.begin() as conn:
+        applied = {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+    for version, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(
+                SchemaMigration.__table__.insert().values(version=version, applied_at=datetime.utcnow())
+            )
+        print(f"Applied migration {version}")
@@ -0,0 +1,162 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set
+
+from .inference_backends import import_inference_libraries, load_backend, load_tokenizer
+from .tokenization import TokenizationStage
+
+WARMUP_TEXTS = ["This book was great!", "This book was terrible."]
+
+
+class LoadedModel:
+    """Một checkpoint đã nạp: backend, tokenizer và thống kê thời gian nạp"""
+
+    def __init__(self, version: str, model_path: str, backend_name: str, truncation: str,
+                 intra_op_threads: Optional[int] = None):
+        self.version = version
+        self.model_path = model_path
+        self.backend_name = backend_name
+        self.truncation = truncation
+        self.intra_op_threads = intra_op_threads
+        self.backend = None
+        self.tokenizer = None
+        self.tokenization: Optional[TokenizationStage] = None
+        self.state = "loading"  # loading | ready | failed
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self.loaded_at: Optional[datetime] = None
+
+    @property
+    def cache_namespace(self) -> str:
+        return f"{os.path.abspath(self.model_path)}:{self.backend_name}:{self.truncation}"
+
+    def load(self):
+        """Nạp model và chạy warm-up; ghi lại thời gian từng bước (imports, tokenizer, weights, warmup)"""
+        started = time.perf_counter()
+        mark = started
+
+        def step(name: str):
+            nonlocal mark
+            now = time.perf_counter()
+            self.timings[f"{name}_s"] = round(now - mark, 3)
+            mark = now
+
+        try:
+            if not os.path.exists(self.model_path):
+                raise ValueError(f"Model path does not exist: {self.model_path}")
+
+            print(f"Loading model {self.version} from: {self.model_path} (backend: {self.backend_name})")
+            import_inference_libraries(self.backend_name)
+            step("imports")
+            self.tokenizer = load_tokenizer()
+            self.tokenization = TokenizationStage(self.tokenizer, strategy=self.truncation)
+            step("tokenizer")
+            self.backend = load_backend(self.backend_name, self.model_path, self.intra_op_threads)
+            step("weights")
+            # Chạy thử một batch để các request đầu tiên không phải trả chi phí khởi tạo
+            self.predict(WARMUP_TEXTS)
+            step("warmup")
+            self.state = "ready"
+            self.loaded_at = datetime.utcnow()
+            print(f"Model {self.version} loaded successfully: {self.timings}")
+        except Exception as e:
+            self.backend = None
+            self.error = str(e)
+            self.state = "failed"
+            print(f"Error loading model {self.version}: {str(e)}")
+        finally:
+            self.timings["total_s"] = round(time.perf_counter() - started, 3)
+
+    def predict(self, texts: List[str]) -> List[Dict]:
+        """One padded forward pass per token-length bucket"""
+        probabilities = self.tokenization.predict(texts, self.backend.predict_logits)
+        labels = probabilities.argmax(axis=-1)
+        return [
+            {'label': f"LABEL_{int(label)}", 'score': float(probabilities[i, label]), 'model_version': self.version}
+            for i, label in enumerate(labels)
+        ]
+
+    def info(self) -> Dict:
+        return {
+            "version": self.version,
+            "model_path": self.model_path,
+            "backend": self.backend_name,
+            "truncation": self.truncation,
+            "intra_op_threads": self.intra_op_threads,
+            "state": self.state,
+            "error": self.error,
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "startup_timings": self.timings
+        }
+
+
+class ModelRegistry:
+    """Giữ nhiều checkpoint đã nạp và con trỏ tới model đang phục vụ.
+
+    Đổi model chỉ là gán lại `active` sau khi model mới đã warm-up xong; mỗi batch
+    lấy tham chiếu tới model một lần lúc bắt đầu nên batch đang chạy vẫn hoàn tất
+    trên model cũ.
+    """
+
+    def __init__(self):
+        self._models: Dict[str, LoadedModel] = {}
+        self._active: Optional[LoadedModel] = None
+        # Version đang nạp, giữ chỗ để hai request nạp cùng version không cùng chạy
+        self._loading: Set[str] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def active(self) -> Optional[LoadedModel]:
+        return self._active
+
+    def get(self, version: str) -> Optional[LoadedModel]:
+        return self._models.get(version)
+
+    def load(self, version: str, model_path: str, backend_name: str, truncation: str,
+             intra_op_threads: Optional[int] = None) -> LoadedModel:
+        """Nạp checkpoint (blocking); model chỉ được đăng ký nếu nạp và warm-up thành công"""
+        with self._lock:
+            if version in self._models:
+                raise ValueError(f"Model version {version} is already loaded")
+            if version in self._loading:
+                raise ValueError(f"Model version {version} is already being loaded")
+            self._loading.add(version)
+        try:
+            model = LoadedModel(version, model_path, backend_name, truncation, intra_op_threads)
+            model.load()
+            if model.state == "ready":
+                with self._lock:
+                    self._models[version] = model
+            return model
+        finally:
+            with self._lock:
+                self._loading.discard(version)
+
+    def activate(self, version: str) -> LoadedModel:
+        with self._lock:
+            model = self._models.get(version)
+            if model is None:
+                raise KeyError(f"Model version {version} is not loaded")
+            previous = self._active
+            self._active = model
+        if previous is not model:
+            print(f"Active model switched from {previous.version if previous else None} to {version}")
+        return model
+
+    def unload(self, version: str):
+        with self._lock:
+            model = self._models.get(version)
+            if model is None:
+                raise KeyError(f"Model version {version} is not loaded")
+            if model is self._active:
+                raise ValueError(f"Model version {version} is active and cannot be unloaded")
+            del self._models[version]
+
+    def list(self) -> List[Dict]:
+        active = self._active
+        return [
+            dict(model.info(), active=model is active)
+            for model in self._models.values()
+        ]
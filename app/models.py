@@ -15,7 +15,8 @@ class BookDB(Base):
     price = Column(Float, nullable=False)
     description = Column(String(10000))
     imageUrl = Column(String(500))
-    comments = relationship("CommentDB", back_populates="book", cascade="all, delete-orphan")
+    comments = relationship("CommentDB", back_populates="book", cascade="all, delete-orphan",
+                            order_by="CommentDB.timestamp.desc()")
 
 class CommentDB(Base):
     __tablename__ = "comments"
@@ -31,6 +32,21 @@ class CommentDB(Base):
     book = relationship("BookDB", back_populates="comments")
     replies = relationship("ReplyDB", back_populates="comment", cascade="all, delete-orphan")
 
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+
+    version = Column(String(100), primary_key=True)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+class BookSentimentSummary(Base):
+    """Số comment theo sentiment của từng sách, cập nhật dần khi thêm comment hoặc sửa sentiment"""
+    __tablename__ = "book_sentiment_summary"
+
+    book_id = Column(String(36), ForeignKey("books.id"), primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    positive = Column(Integer, nullable=False, default=0)
+    negative = Column(Integer, nullable=False, default=0)
+
 class ReplyDB(Base):
     __tablename__ = "replies"
 
@@ -77,11 +93,26 @@ class Book(BaseModel):
     class Config:
         from_attributes = True
 
+class SentimentCounts(BaseModel):
+    total: int = 0
+    positive: int = 0
+    negative: int = 0
+
+class BookSummary(BaseModel):
+    """Book không kèm comments, dùng cho danh sách sách"""
+    id: str
+    title: str
+    author: str
+    price: float
+    description: Optional[str] = None
+    imageUrl: Optional[str] = None
+    sentiment: SentimentCounts
+
 class ModelMetrics(Base):
     __tablename__ = "model_metrics"
 
     id = Column(String(36), primary_key=True)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     
     # Performance metrics
     total_predictions = Column(Integer, default=0)
@@ -98,6 +129,22 @@ class ModelMetrics(Base):
     min_confidence = Column(Float)
     max_confidence = Column(Float)
 
+class MetricsRollup(Base):
+    """Metrics gộp theo khung thời gian cố định: resolution là "1m", "1h" hoặc "1d"."""
+    __tablename__ = "metrics_rollups"
+
+    resolution = Column(String(4), primary_key=True)
+    bucket_start = Column(DateTime, primary_key=True)
+    total = Column(Integer, default=0)
+    positive = Column(Integer, default=0)
+    negative = Column(Integer, default=0)
+    confirmed = Column(Integer, default=0)
+    correct = Column(Integer, default=0)
+    confidence_sum = Column(Float, default=0.0)
+    confidence_min = Column(Float)
+    confidence_max = Column(Float)
+    response_time_sum = Column(Float, default=0.0)  # milliseconds
+
 class PredictionLog(Base):
     __tablename__ = "prediction_logs"
     
@@ -107,4 +154,23 @@ class PredictionLog(Base):
     predicted_sentiment = Column(String(20))
     confidence_score = Column(Float)
     response_time = Column(Float)  # milliseconds
-    comment_id = Column(String(36), ForeignKey("comments.id")) 
\ No newline at end of file
+    comment_id = Column(String(36), ForeignKey("comments.id")) 
+    model_version = Column(String(100))
+class ShadowPrediction(Base):
+    """Kết quả của model chính và model ứng viên trên một comment được lấy mẫu (shadow scoring)"""
+    __tablename__ = "shadow_predictions"
+
+    id = Column(String(36), primary_key=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    # Không khóa ngoại: shadow có thể chấm xong trước khi comment được ghi
+    comment_id = Column(String(36), index=True)
+    primary_version = Column(String(100))
+    primary_sentiment = Column(String(20))
+    primary_confidence = Column(Float)
+    primary_latency_ms = Column(Float)
+    shadow_version = Column(String(100), index=True)
+    shadow_sentiment = Column(String(20))
+    shadow_confidence = Column(Float)
+    shadow_latency_ms = Column(Float)
+    # Nhãn người dùng sửa sau đó, để so accuracy của hai model
+    corrected_sentiment = Column(String(20))
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+
+class PredictionCache:
+    """Cache kết quả dự đoán theo hash của text đã chuẩn hoá.
+
+    Tầng bộ nhớ là LRU có giới hạn và TTL; tầng đĩa (sqlite, tuỳ chọn) giữ kết quả qua
+    các lần khởi động. Mọi key đều gắn với `namespace` (đường dẫn checkpoint), nên
+    đổi model sẽ tự vô hiệu hoá cache cũ.
+
+    `set` không ghi đĩa trên thread của caller (thường là event loop): dòng mới được gom
+    lại và một thread nền ghi theo lô mỗi `disk_flush_interval` giây. Thread này cũng
+    định kỳ xoá dòng hết hạn, dòng của namespace khác và dòng cũ nhất vượt `disk_max_rows`.
+    Code async dùng `get_async`, đọc tầng đĩa ở threadpool bằng kết nối chỉ đọc riêng.
+    """
+
+    def __init__(self, namespace: str, max_entries: Optional[int] = None,
+                 ttl_seconds: Optional[float] = None, disk_path: Optional[str] = None):
+        self.namespace = namespace
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("PREDICTION_CACHE_SIZE", "10000"))
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else float(os.getenv("PREDICTION_CACHE_TTL_S", "86400"))
+        self.disk_path = disk_path if disk_path is not None else os.getenv("PREDICTION_CACHE_DISK", "")
+        self.disk_max_rows = int(os.getenv("PREDICTION_CACHE_DISK_MAX_ROWS", "100000"))
+        self.disk_flush_interval = float(os.getenv("PREDICTION_CACHE_DISK_FLUSH_S", "1"))
+        self.purge_interval = float(os.getenv("PREDICTION_CACHE_PURGE_INTERVAL_S", "300"))
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # Kết nối ghi dùng chung giữa các thread, mọi lần ghi giữ _disk_lock;
+        # đọc dùng kết nối riêng (_reader, _read_lock)
+        self._disk_lock = threading.Lock()
+        self._read_lock = threading.Lock()
+        self._pending: List[Tuple[str, str, str, Optional[float]]] = []
+        self._wakeup = threading.Event()
+        self._last_purge = 0.0
+        self._disk = self._open_disk() if self.disk_path else None
+        self._reader = self._open_reader() if self._disk is not None else None
+        if self._disk is not None:
+            threading.Thread(target=self._disk_writer, name="prediction-cache-writer", daemon=True).start()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        # Model là uncased nên lowercase và gộp khoảng trắng không đổi kết quả dự đoán
+        return " ".join(text.lower().split())
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(self.normalize(text).encode("utf-8")).hexdigest()
+
+    def _open_disk(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(os.path.abspath(self.disk_path)), exist_ok=True)
+        conn = sqlite3.connect(self.disk_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS predictions ("
+            "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, result TEXT NOT NULL, expires_at REAL)"
+        )
+        # Xoá kết quả của các checkpoint khác
+        conn.execute("DELETE FROM predictions WHERE namespace != ?", (self.namespace,))
+        conn.commit()
+        return conn
+
+    def _open_reader(self) -> sqlite3.Connection:
+        return sqlite3.connect(f"file:{os.path.abspath(self.disk_path)}?mode=ro", uri=True,
+                               check_same_thread=False, timeout=1)
+
+    def _expiry(self) -> Optional[float]:
+        return time.time() + self.ttl_seconds if self.ttl_seconds > 0 else None
+
+    def _get_memory(self, key: str, now: float) -> Tuple[Optional[Dict], str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires_at = entry
+                if expires_at is None or expires_at > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(result), self.namespace
+                del self._entries[key]
+            return None, self.namespace
+
+    def _get_disk(self, key: str, namespace: str, now: float) -> Optional[Dict]:
+        # Kết nối đọc riêng: WAL cho phép đọc song song với transaction của thread ghi,
+        # nên không phải chờ _disk_lock trong lúc ghi lô hoặc dọn bảng
+        with self._read_lock:
+            row = self._reader.execute(
+                "SELECT result, expires_at FROM predictions WHERE key = ? AND namespace = ?",
+                (key, namespace)
+            ).fetchone()
+        if row and (row[1] is None or row[1] > now):
+            result = json.loads(row[0])
+            with self._lock:
+                if namespace == self.namespace:
+                    self._store_memory(key, result, row[1])
+                self.disk_hits += 1
+            return dict(result)
+        return None
+
+    def _miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def get(self, text: str) -> Optional[Dict]:
+        """Tra cache (blocking); tầng đĩa được đọc trên thread của caller"""
+        key = self._key(text)
+        now = time.time()
+        result, namespace = self._get_memory(key, now)
+        if result is None and self._disk is not None:
+            result = self._get_disk(key, namespace, now)
+        if result is None:
+            self._miss()
+        return result
+
+    async def get_async(self, text: str) -> Optional[Dict]:
+        """Như get, nhưng tầng đĩa được đọc ở threadpool để không chặn event loop"""
+        key = self._key(text)
+        now = time.time()
+        result, namespace = self._get_memory(key, now)
+        if result is None and self._disk is not None:
+            result = await asyncio.to_thread(self._get_disk, key, namespace, now)
+        if result is None:
+            self._miss()
+        return result
+
+    def set(self, text: str, result: Dict, namespace: Optional[str] = None):
+        """Lưu kết quả; bỏ qua nếu kết quả thuộc namespace khác (model đã bị thay trong lúc chạy)"""
+        key = self._key(text)
+        expires_at = self._expiry()
+        with self._lock:
+            if namespace is not None and namespace != self.namespace:
+                return
+            self._store_memory(key, dict(result), expires_at)
+            if self._disk is not None:
+                self._pending.append((key, self.namespace, json.dumps(result), expires_at))
+
+    def _disk_writer(self):
+        while True:
+            self._wakeup.wait(self.disk_flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush_disk()
+            except Exception as e:
+                print(f"Error writing prediction cache to disk: {e}")
+
+    def flush_disk(self):
+        """Ghi các kết quả đang chờ trong một transaction; định kỳ dọn bảng"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            namespace = self.namespace
+        with self._disk_lock:
+            if pending:
+                self._disk.executemany(
+                    "INSERT OR REPLACE INTO predictions (key, namespace, result, expires_at) VALUES (?, ?, ?, ?)",
+                    pending
+                )
+            if time.time() - self._last_purge > self.purge_interval:
+                self._purge(namespace)
+                self._last_purge = time.time()
+            self._disk.commit()
+
+    def _purge(self, namespace: str):
+        self._disk.execute("DELETE FROM predictions WHERE expires_at IS NOT NULL AND expires_at <= ?", (time.time(),))
+        self._disk.execute("DELETE FROM predictions WHERE namespace != ?", (namespace,))
+        # INSERT OR REPLACE cấp rowid mới nên rowid nhỏ nhất là dòng ghi lâu nhất
+        excess = self._disk.execute("SELECT COUNT(*) FROM predictions").fetchone()[0] - self.disk_max_rows
+        if excess > 0:
+            self._disk.execute(
+                "DELETE FROM predictions WHERE rowid IN (SELECT rowid FROM predictions ORDER BY rowid LIMIT ?)",
+                (excess,)
+            )
+
+    def _store_memory(self, key: str, result: Dict, expires_at: Optional[float]):
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = (result, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def switch_namespace(self, namespace: str):
+        """Đổi sang model khác: bỏ các kết quả trong bộ nhớ và trên đĩa của model cũ"""
+        with self._lock:
+            if namespace == self.namespace:
+                return
+            self.namespace = namespace
+            self._entries.clear()
+            self._pending = [row for row in self._pending if row[1] == namespace]
+        if self._disk is not None:
+            # Dòng của model cũ được xoá ở lần dọn tiếp theo của thread nền
+            self._last_purge = 0.0
+            self._wakeup.set()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending = []
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.execute("DELETE FROM predictions")
+                self._disk.commit()
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "namespace": self.namespace,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "disk_enabled": self._disk is not None,
+            "disk_pending": len(self._pending),
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+        }
@@ -0,0 +1,179 @@
+import asyncio
+import os
+import threading
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+from sqlalchemy.exc import DataError, IntegrityError
+
+from .database import session_scope
+from .models import PredictionLog
+
+OVERFLOW_POLICIES = ("drop_oldest", "drop_newest")
+
+
+class PredictionLogWriter:
+    """Gom các dòng PredictionLog trong bộ nhớ và ghi bằng một lệnh insert nhiều dòng.
+
+    `add` chỉ append vào buffer nên đường tạo comment không còn INSERT + COMMIT riêng.
+    Buffer được ghi khi đủ `batch_size` dòng hoặc sau `flush_interval_ms`, và khi
+    shutdown. `add` được gọi trên event loop nên không bao giờ tự ghi DB khi worker đang
+    chạy; khi buffer chạm `max_buffer` (DB chậm hoặc lỗi), `overflow_policy` quyết định:
+      - drop_oldest: bỏ dòng cũ nhất
+      - drop_newest: bỏ dòng vừa tới
+    Lô ghi lỗi được thử lại; lỗi dữ liệu (vd. vi phạm khóa ngoại) hoặc sau `max_retries`
+    lần lỗi liên tiếp thì lô được ghi từng dòng và chỉ các dòng lỗi bị bỏ (`rejected`).
+    """
+
+    def __init__(self, batch_size: Optional[int] = None, flush_interval_ms: Optional[float] = None,
+                 max_buffer: Optional[int] = None, overflow_policy: Optional[str] = None,
+                 max_retries: Optional[int] = None, model=PredictionLog):
+        # Bảng đích; mặc định PredictionLog, ShadowScorer dùng lại writer cho ShadowPrediction
+        self.model = model
+        self.batch_size = batch_size or int(os.getenv("PREDICTION_LOG_BATCH_SIZE", "200"))
+        self.flush_interval_ms = flush_interval_ms or float(os.getenv("PREDICTION_LOG_FLUSH_MS", "500"))
+        self.max_buffer = max(max_buffer or int(os.getenv("PREDICTION_LOG_MAX_BUFFER", "10000")), self.batch_size)
+        self.overflow_policy = overflow_policy or os.getenv("PREDICTION_LOG_OVERFLOW", "drop_oldest")
+        if self.overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown prediction log overflow policy: {self.overflow_policy}")
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("PREDICTION_LOG_MAX_RETRIES", "3"))
+        self._buffer: Deque[Dict] = deque()
+        self._lock = threading.Lock()
+        # Chỉ một flush chạy tại một thời điểm để thứ tự ghi giữ đúng thứ tự add
+        self._flush_lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.failed_flushes = 0
+        self._retries = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return len(self._buffer)
+
+    def add(self, row: Dict):
+        """Đưa một dòng (dict theo cột của `model`) vào buffer"""
+        with self._lock:
+            if len(self._buffer) >= self.max_buffer:
+                self.dropped += 1
+                if self.overflow_policy == "drop_newest":
+                    return
+                self._buffer.popleft()
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+        if self._task is None:
+            # Chưa có worker (script ngoài app, không có event loop): ghi ngay như trước
+            self.flush()
+        elif full:
+            self._wake()
+
+    def find_latest(self, comment_id: str) -> Optional[Dict]:
+        """Dòng mới nhất của comment còn nằm trong buffer (chưa ghi xuống DB)"""
+        with self._lock:
+            for row in reversed(self._buffer):
+                if row["comment_id"] == comment_id:
+                    return row
+        return None
+
+    def flush(self) -> int:
+        """Ghi toàn bộ buffer theo từng lô `batch_size` dòng; trả về số dòng đã ghi"""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch: List[Dict] = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+                if not batch:
+                    return written
+                try:
+                    with session_scope() as db:
+                        db.bulk_insert_mappings(self.model, batch)
+                except Exception as e:
+                    self.failed_flushes += 1
+                    print(f"Error writing {len(batch)} prediction logs: {e}")
+                    if isinstance(e, (IntegrityError, DataError)) or self._retries >= self.max_retries:
+                        self._retries = 0
+                        rows_written, done = self._write_rows(batch)
+                        written += rows_written
+                        if done:
+                            continue
+                    else:
+                        self._retries += 1
+                        self._requeue(batch)
+                    return written
+                self._retries = 0
+                written += len(batch)
+                self.written += len(batch)
+
+    def _write_rows(self, batch: List[Dict]):
+        """Ghi từng dòng để tách dòng lỗi khỏi lô; trả về (số dòng đã ghi, đã xử lý hết lô)"""
+        written = 0
+        for index, row in enumerate(batch):
+            try:
+                with session_scope() as db:
+                    db.bulk_insert_mappings(self.model, [row])
+            except (IntegrityError, DataError) as e:
+                self.rejected += 1
+                print(f"Dropping prediction log for comment {row.get('comment_id')}: {e}")
+                continue
+            except Exception as e:
+                # Không phải lỗi của dòng này (DB không truy cập được): giữ phần còn lại để thử sau
+                print(f"Error writing prediction logs: {e}")
+                self._requeue(batch[index:])
+                return written, False
+            written += 1
+            self.written += 1
+        return written, True
+
+    def _requeue(self, batch: List[Dict]):
+        # Đưa lô lỗi về đầu buffer để lần flush sau thử lại, không vượt quá max_buffer
+        with self._lock:
+            room = max(self.max_buffer - len(self._buffer), 0)
+            keep = batch[-room:] if room else []
+            self.dropped += len(batch) - len(keep)
+            self._buffer.extendleft(reversed(keep))
+
+    def stats(self) -> Dict:
+        return {
+            "buffered": self.depth,
+            "written": self.written,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "failed_flushes": self.failed_flushes,
+            "batch_size": self.batch_size,
+            "flush_interval_ms": self.flush_interval_ms,
+            "overflow_policy": self.overflow_policy
+        }
+
+    def _wake(self):
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def start(self):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # Ghi nốt các prediction còn trong buffer trước khi tắt
+        await asyncio.to_thread(self.flush)
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._buffer:
+                await asyncio.to_thread(self.flush)
+
+
+prediction_log_writer = PredictionLogWriter()
@@ -0,0 +1,205 @@
+import asyncio
+import json
+import os
+import uuid
+from typing import Callable, Optional, Set
+
+from . import leader
+
+# deliver(message, book_id): gửi message tới các WebSocket client của worker hiện tại
+Deliver = Callable[[dict, Optional[str]], None]
+
+# Giới hạn một dòng envelope; mặc định 64 KiB của StreamReader nhỏ hơn một comment 10k ký tự
+PUBSUB_MAX_MESSAGE_BYTES = int(os.getenv("PUBSUB_MAX_MESSAGE_BYTES", str(1024 * 1024)))
+
+
+async def _read_message(reader: asyncio.StreamReader) -> Optional[bytes]:
+    """Dòng tiếp theo (b"" khi EOF), hoặc None nếu dòng vượt giới hạn và đã bị bỏ qua.
+
+    Dòng quá dài bị bỏ tới hết ký tự xuống dòng của nó, kết nối vẫn dùng tiếp được.
+    """
+    oversized = False
+    while True:
+        try:
+            line = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError:
+            return b""
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+            oversized = True
+            continue
+        if oversized:
+            print(f"Dropping pub/sub message larger than {PUBSUB_MAX_MESSAGE_BYTES} bytes")
+            return None
+        return line
+
+
+class PubSubBackend:
+    """Kênh phát message giữa các worker. Message luôn được giao cho client local ngay lập tức"""
+
+    # True khi message có thể tới client của worker khác, nên phải publish kể cả khi
+    # worker hiện tại không có client nào
+    cross_process = False
+
+    def __init__(self):
+        self._deliver: Optional[Deliver] = None
+
+    async def start(self, deliver: Deliver):
+        self._deliver = deliver
+
+    async def stop(self):
+        pass
+
+    def publish(self, message: dict, book_id: Optional[str] = None):
+        self._deliver(message, book_id)
+
+
+class InProcessBackend(PubSubBackend):
+    """Chỉ một worker: giao trực tiếp cho client local"""
+
+
+class _UnixSocketBroker:
+    """Broker chuyển tiếp từng dòng JSON nhận được tới mọi worker khác đang kết nối.
+
+    Mỗi peer có giới hạn `max_buffer_bytes` dữ liệu chờ gửi; peer đọc không kịp bị ngắt
+    (nó tự kết nối lại) thay vì làm buffer của broker tăng không giới hạn.
+    """
+
+    def __init__(self, path: str, max_buffer_bytes: int):
+        self.path = path
+        self.max_buffer_bytes = max_buffer_bytes
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._handlers: Set[asyncio.Task] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # socket cũ của broker đã chết
+        self._server = await asyncio.start_unix_server(self._handle, path=self.path, limit=PUBSUB_MAX_MESSAGE_BYTES)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for writer in list(self._writers):
+            writer.close()
+        # Đóng writer làm readline() trả về EOF, handler tự kết thúc
+        if self._handlers:
+            await asyncio.wait(list(self._handlers), timeout=1)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        self._handlers.add(asyncio.current_task())
+        try:
+            while True:
+                line = await _read_message(reader)
+                if line is None:
+                    continue
+                if not line:
+                    break
+                for other in list(self._writers):
+                    if other is writer:
+                        continue
+                    if other.is_closing() or other.transport.get_write_buffer_size() > self.max_buffer_bytes:
+                        print("Pub/sub peer is not keeping up, disconnecting it")
+                        self._writers.discard(other)
+                        other.close()
+                        continue
+                    other.write(line)
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"Pub/sub peer connection error: {e}")
+        finally:
+            self._writers.discard(writer)
+            self._handlers.discard(asyncio.current_task())
+            writer.close()
+
+
+class UnixSocketBackend(PubSubBackend):
+    """Pub/sub giữa các worker uvicorn trên cùng máy qua một Unix socket.
+
+    Worker nào giữ được file lock sẽ chạy broker; các worker khác (và chính nó) kết nối
+    tới broker. Khi worker giữ broker chết, lock được giải phóng và một worker khác
+    thay thế ở lần kết nối lại. Trong lúc mất kết nối, message vẫn được giao cho
+    client local.
+    """
+
+    cross_process = True
+
+    def __init__(self, path: Optional[str] = None, reconnect_delay: float = 1.0,
+                 max_buffer_bytes: int = 8 * 1024 * 1024):
+        super().__init__()
+        self.path = path or os.getenv("PUBSUB_SOCKET", "/tmp/sentiment-pubsub.sock")
+        self.reconnect_delay = reconnect_delay
+        self.max_buffer_bytes = max_buffer_bytes
+        self.worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._broker: Optional[_UnixSocketBroker] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self, deliver: Deliver):
+        await super().start(deliver)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._broker is not None:
+            await self._broker.stop()
+            leader.unlock(f"{self.path}.lock")
+
+    def publish(self, message: dict, book_id: Optional[str] = None):
+        self._deliver(message, book_id)
+        writer = self._writer
+        if writer is None or writer.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer_bytes:
+            print("Pub/sub broker is not keeping up, dropping cross-worker message")
+            return
+        envelope = {"origin": self.worker_id, "book_id": book_id, "message": message}
+        # ensure_ascii=False: tiếng Việt/emoji không bị escape thành \uXXXX (gấp 6-12 lần)
+        line = json.dumps(envelope, separators=(",", ":"), ensure_ascii=False).encode("utf-8") + b"\n"
+        if len(line) > PUBSUB_MAX_MESSAGE_BYTES:
+            print(f"Pub/sub message of {len(line)} bytes exceeds PUBSUB_MAX_MESSAGE_BYTES, not sent to other workers")
+            return
+        writer.write(line)
+
+    async def _connect(self):
+        try:
+            return await asyncio.open_unix_connection(self.path, limit=PUBSUB_MAX_MESSAGE_BYTES)
+        except (FileNotFoundError, ConnectionRefusedError):
+            if self._broker is None and leader.try_lock(f"{self.path}.lock"):
+                self._broker = _UnixSocketBroker(self.path, self.max_buffer_bytes)
+                await self._broker.start()
+                print(f"Pub/sub broker listening on {self.path}")
+            return await asyncio.open_unix_connection(self.path, limit=PUBSUB_MAX_MESSAGE_BYTES)
+
+    async def _run(self):
+        while True:
+            try:
+                reader, self._writer = await self._connect()
+                while True:
+                    line = await _read_message(reader)
+                    if line is None:
+                        continue
+                    if not line:
+                        break
+                    envelope = json.loads(line)
+                    if envelope.get("origin") != self.worker_id:
+                        self._deliver(envelope["message"], envelope.get("book_id"))
+            except (ConnectionError, OSError, ValueError) as e:
+                print(f"Pub/sub connection error: {e}")
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+            await asyncio.sleep(self.reconnect_delay)
+
+
+def create_backend(name: Optional[str] = None) -> PubSubBackend:
+    name = name or os.getenv("PUBSUB_BACKEND", "inprocess")
+    if name == "unix":
+        return UnixSocketBackend()
+    if name == "inprocess":
+        return InProcessBackend()
+    raise ValueError(f"Unknown pub/sub backend: {name}")
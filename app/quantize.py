@@ -0,0 +1,119 @@
+import argparse
+import io
+import json
+import os
+import sys
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from .export_model import export_torchscript
+from .inference_backends import (
+    DEFAULT_MODEL_PATH, INT8_TORCHSCRIPT_FILENAME, QuantizedTorchBackend, TorchBackend, load_hf_model, load_tokenizer
+)
+from .tokenization import TRUNCATION_STRATEGIES, TokenizationStage
+
+REPORT_FILENAME = "quantization.json"
+
+
+def quantize_dynamic_int8(model):
+    """Lượng tử hoá động int8 cho các lớp Linear (trọng số int8, activation lượng tử hoá lúc chạy)"""
+    import torch
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8).eval()
+
+
+def model_size_mb(model) -> float:
+    import torch
+
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / (1024 * 1024)
+
+
+def load_test_split(max_samples: Optional[int] = None):
+    """Tập test IMDB giống `app/train.py`; `max_samples` lấy cùng tập con shuffle(seed=42) như small_test_dataset"""
+    from datasets import load_dataset
+
+    test = load_dataset("imdb")["test"]
+    if max_samples:
+        test = test.shuffle(seed=42).select(range(min(max_samples, len(test))))
+    return test["text"], test["label"]
+
+
+def evaluate(backend, stage: TokenizationStage, texts: List[str], labels: List[int], batch_size: int = 32) -> Dict:
+    """Accuracy qua cùng TokenizationStage (cắt ngắn, bucket theo độ dài) mà server dùng"""
+    correct = 0
+    started = time.perf_counter()
+    for start in range(0, len(texts), batch_size):
+        probabilities = stage.predict(texts[start:start + batch_size], backend.predict_logits)
+        predictions = probabilities.argmax(axis=-1)
+        correct += int((predictions == np.asarray(labels[start:start + batch_size])).sum())
+    elapsed = time.perf_counter() - started
+    return {
+        "accuracy": correct / len(texts) if texts else 0.0,
+        "samples": len(texts),
+        "seconds": round(elapsed, 2),
+        "samples_per_sec": round(len(texts) / elapsed, 2) if elapsed else 0.0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a dynamic-int8 variant of the sentiment model behind an accuracy gate")
+    parser.add_argument("--model-path", default=DEFAULT_MODEL_PATH)
+    parser.add_argument("--output-dir", help="Where to publish the int8 model (default: the checkpoint directory)")
+    parser.add_argument("--max-accuracy-drop", type=float,
+                        default=float(os.getenv("QUANTIZE_MAX_ACCURACY_DROP", "0.01")),
+                        help="Refuse to publish if fp32 accuracy - int8 accuracy exceeds this (absolute)")
+    parser.add_argument("--max-samples", type=int, default=None,
+                        help="Evaluate on the first N test reviews after shuffle(seed=42) instead of the full split")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--truncation", choices=TRUNCATION_STRATEGIES,
+                        default=os.getenv("SENTIMENT_TRUNCATION", "head_tail"),
+                        help="Truncation strategy the server will use (SENTIMENT_TRUNCATION)")
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or args.model_path
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = load_tokenizer()
+    stage = TokenizationStage(tokenizer, strategy=args.truncation)
+    model = load_hf_model(args.model_path)
+    quantized = quantize_dynamic_int8(load_hf_model(args.model_path))
+    texts, labels = load_test_split(args.max_samples)
+
+    # Gate chạy trên chính file TorchScript sẽ được phục vụ, không phải model eager
+    path = os.path.join(output_dir, INT8_TORCHSCRIPT_FILENAME)
+    staging_path = f"{path}.tmp"
+    encoded = tokenizer(texts[:2], padding=True, truncation=True, return_tensors="np")
+    export_torchscript(quantized, encoded, staging_path)
+
+    print(f"Evaluating fp32 and traced int8 models on {len(texts)} IMDB test reviews ({args.truncation} truncation)...")
+    fp32 = evaluate(TorchBackend(model), stage, texts, labels, args.batch_size)
+    int8 = evaluate(QuantizedTorchBackend(staging_path), stage, texts, labels, args.batch_size)
+    fp32["size_mb"] = round(model_size_mb(model), 1)
+    int8["size_mb"] = round(model_size_mb(quantized), 1)
+    drop = fp32["accuracy"] - int8["accuracy"]
+    report = {
+        "fp32": fp32,
+        "int8": int8,
+        "truncation": args.truncation,
+        "accuracy_drop": round(drop, 4),
+        "max_accuracy_drop": args.max_accuracy_drop,
+        "published": drop <= args.max_accuracy_drop
+    }
+    print(json.dumps(report, indent=2))
+
+    if not report["published"]:
+        os.remove(staging_path)
+        print(f"Accuracy drop {drop:.4f} exceeds {args.max_accuracy_drop:.4f}, int8 model NOT published")
+        sys.exit(1)
+
+    os.replace(staging_path, path)
+    with open(os.path.join(output_dir, REPORT_FILENAME), "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Published int8 model to {path}, serve it with SENTIMENT_BACKEND=torch-int8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional, Set
+
+from . import crud, leader, models
+from .database import session_scope
+
+
+class ScoringQueue:
+    """Hàng đợi in-process chấm điểm sentiment cho các comment đã được lưu.
+
+    Endpoint tạo comment chỉ cần insert rồi `enqueue`; worker sẽ chạy model, lưu
+    sentiment và broadcast sau. Job lỗi được thử lại với backoff tăng dần.
+
+    Comment có `sentiment IS NULL` cũ hơn `rescan_grace` giây được quét lại mỗi
+    `rescan_interval` giây (lần đầu ngay khi khởi động), nhưng chỉ bởi một worker giữ
+    leader lock: nếu mọi worker cùng quét, mỗi comment bị chấm điểm N lần. Khoảng
+    `rescan_grace` tránh lấy comment mà worker khác vừa nhận và đang chấm điểm.
+    """
+
+    def __init__(self, analyzer, num_workers: Optional[int] = None,
+                 max_attempts: Optional[int] = None, retry_backoff: Optional[float] = None):
+        self.analyzer = analyzer
+        self.num_workers = num_workers or int(os.getenv("SCORING_WORKERS", "4"))
+        self.max_attempts = max_attempts or int(os.getenv("SCORING_MAX_ATTEMPTS", "3"))
+        self.retry_backoff = retry_backoff if retry_backoff is not None else float(os.getenv("SCORING_RETRY_BACKOFF_S", "1.0"))
+        self.rescan_interval = float(os.getenv("SCORING_RESCAN_INTERVAL_S", "60"))
+        self.rescan_grace = float(os.getenv("SCORING_RESCAN_GRACE_S", "120"))
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: Set[str] = set()
+        self._workers: List[asyncio.Task] = []
+        self._rescan_task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self):
+        """Khởi động worker và vòng quét lại các comment chưa được chấm điểm"""
+        if self._workers:
+            return
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.num_workers)]
+        self._rescan_task = asyncio.create_task(self._rescan_loop())
+
+    async def stop(self):
+        tasks = self._workers + ([self._rescan_task] if self._rescan_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._rescan_task = None
+
+    async def _rescan_loop(self):
+        while True:
+            # Worker giữ lock chết thì worker khác nhận vai trò ở lần thử tiếp theo
+            if leader.is_leader("scoring-rescan"):
+                try:
+                    before = datetime.utcnow() - timedelta(seconds=self.rescan_grace)
+                    comment_ids = await asyncio.to_thread(self._find_unscored, before)
+                    queued = len(self._pending)
+                    for comment_id in comment_ids:
+                        self.enqueue(comment_id)
+                    if len(self._pending) > queued:
+                        print(f"Scoring queue picked up {len(self._pending) - queued} unscored comments")
+                except Exception as e:
+                    print(f"Error rescanning unscored comments: {e}")
+            await asyncio.sleep(self.rescan_interval)
+
+    def enqueue(self, comment_id: str, attempt: int = 1):
+        if self._queue is None:
+            raise RuntimeError("Scoring queue is not started")
+        if attempt == 1:
+            if comment_id in self._pending:
+                return
+            self._pending.add(comment_id)
+        self._queue.put_nowait((comment_id, attempt))
+
+    def _find_unscored(self, before: datetime) -> List[str]:
+        with session_scope() as db:
+            rows = db.query(models.CommentDB.id)\
+                .filter(models.CommentDB.sentiment.is_(None), models.CommentDB.timestamp < before)\
+                .order_by(models.CommentDB.timestamp)\
+                .all()
+            return [row.id for row in rows]
+
+    async def _worker(self):
+        while True:
+            comment_id, attempt = await self._queue.get()
+            try:
+                await self._score(comment_id)
+                self._pending.discard(comment_id)
+            except Exception as e:
+                if attempt < self.max_attempts:
+                    delay = self.retry_backoff * (2 ** (attempt - 1))
+                    print(f"Scoring comment {comment_id} failed (attempt {attempt}): {e}, retrying in {delay:.1f}s")
+                    asyncio.get_running_loop().call_later(delay, self.enqueue, comment_id, attempt + 1)
+                else:
+                    # Giữ sentiment null để lần quét lại sau thử tiếp
+                    print(f"Giving up scoring comment {comment_id} after {attempt} attempts: {e}")
+                    self._pending.discard(comment_id)
+            finally:
+                self._queue.task_done()
+
+    async def _score(self, comment_id: str):
+        with session_scope() as db:
+            comment = db.query(models.CommentDB).filter(models.CommentDB.id == comment_id).first()
+            if comment is None or comment.sentiment is not None:
+                return
+            content = comment.content
+        # Session mới chỉ lấy connection khi cần ghi, không giữ connection trong lúc chờ model
+        with session_scope() as db:
+            sentiment = await self.analyzer.analyze_and_broadcast(content, comment_id, db=db)
+            if not sentiment:
+                raise RuntimeError("sentiment analysis returned no result")
+            crud.update_comment_sentiment(db, comment_id, sentiment)
@@ -1,54 +1,126 @@
-from transformers import DistilBertConfig, AutoModelForSequenceClassification, AutoTokenizer, pipeline
-from typing import Dict
+from typing import Dict, List, Optional
+import asyncio
 import os
+import threading
 from .websocket_manager import manager
 import time
+from datetime import datetime
 from .metrics_service import MetricsService
+from .metrics_aggregator import metrics_aggregator
 from sqlalchemy.orm import Session
 from . import crud, models, database
 from .database import engine, get_db
+from .batching import MicroBatcher, InferenceQueueFull
+from .prediction_cache import PredictionCache
+from .inference_backends import DEFAULT_MODEL_PATH
+from .model_registry import ModelRegistry
+from .shadow_scoring import ShadowScorer
+
+
 class SentimentAnalyzer:
     # Model loading
 
-    def __init__(self, model_path: str = "model/my-imdb-sentiment-model/checkpoint-2343", db = None):
-        
-        try:
-            if not os.path.exists(model_path):
-                raise ValueError(f"Model path does not exist: {model_path}")
-                
-            print("Loading model from:", model_path)
-            
-            config = DistilBertConfig.from_pretrained(
-                "distilbert-base-uncased",
-                num_labels=2
-            )
-            
-            model = AutoModelForSequenceClassification.from_pretrained(
-                model_path,
-                config=config,
-                local_files_only=True,
-                ignore_mismatched_sizes=True
-            )
-            
-            tokenizer = AutoTokenizer.from_pretrained("distilbert-base-uncased")
-            self.model = pipeline(
-                task="sentiment-analysis",
-                model=model,
-                tokenizer=tokenizer
-            )
-            print("Model loaded successfully!")
+    def __init__(self, model_path: str = None, db = None,
+                 max_batch_size: int = None, max_wait_ms: float = None, backend: str = None):
+        self.model_path = model_path or os.getenv("SENTIMENT_MODEL_PATH", DEFAULT_MODEL_PATH)
+        self.model_version = os.getenv("SENTIMENT_MODEL_VERSION") or os.path.basename(os.path.normpath(self.model_path))
+        self.backend_name = backend or os.getenv("SENTIMENT_BACKEND", "torch")
+        self.truncation = os.getenv("SENTIMENT_TRUNCATION", "head_tail")
+        self.ready_timeout = float(os.getenv("SENTIMENT_READY_TIMEOUT_S", "300"))
+        self.registry = ModelRegistry()
+        self.cache = PredictionCache(
+            namespace=f"{os.path.abspath(self.model_path)}:{self.backend_name}:{self.truncation}"
+        )
+        self.batcher = MicroBatcher(self._predict_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self.shadow = ShadowScorer(self.registry, self.batcher)
+        # Backfill (analyze_batch) chạy ngoài micro-batcher: giới hạn số lượt chạy cùng lúc,
+        # kích thước mỗi forward pass, và nhường model cho request thật đang chờ
+        self.bulk_slots = threading.BoundedSemaphore(int(os.getenv("BULK_MAX_CONCURRENCY", "1")))
+        self.bulk_forward_batch_size = int(os.getenv("BULK_FORWARD_BATCH_SIZE", str(self.batcher.max_batch_size)))
+        self.bulk_max_yield_s = float(os.getenv("BULK_MAX_YIELD_S", "1"))
+        # Model được nạp ở thread nền (start_loading) hoặc khi có request đầu tiên
+        self.state = "pending"  # pending | loading | ready | failed
+        self.load_error = None
+        self.startup_timings: Dict[str, float] = {}
+        self._loaded = threading.Event()
+        self._load_lock = threading.Lock()
+
+    @property
+    def model(self):
+        active = self.registry.active
+        return active.backend if active else None
 
+    @property
+    def tokenization(self):
+        active = self.registry.active
+        return active.tokenization if active else None
+
+    def start_loading(self):
+        """Bắt đầu nạp model ở thread nền, gọi nhiều lần cũng chỉ nạp một lần"""
+        with self._load_lock:
+            if self.state != "pending":
+                return
+            self.state = "loading"
+        threading.Thread(target=self._load, name="sentiment-model-loader", daemon=True).start()
+
+    def _load(self):
+        try:
+            loaded = self.registry.load(self.model_version, self.model_path, self.backend_name, self.truncation)
+            self.startup_timings = loaded.timings
+            if loaded.state == "ready":
+                # Không ghi đè model đã được kích hoạt qua admin API trong lúc đang nạp
+                if self.registry.active is None:
+                    self.registry.activate(loaded.version)
+                self.state = "ready"
+            elif self.registry.active is None:
+                self.load_error = loaded.error
+                self.state = "failed"
         except Exception as e:
-            print(f"Error loading model: {str(e)}")
-            # Fallback to simple sentiment analysis
-            self.model = None
-            
+            if self.registry.active is None:
+                self.load_error = str(e)
+                self.state = "failed"
+        finally:
+            self._loaded.set()
+
+    @property
+    def is_ready(self) -> bool:
+        return self.state == "ready"
+
+    def wait_until_ready(self, timeout: float = None):
+        """Chặn tới khi model sẵn sàng; raise nếu nạp lỗi hoặc quá thời gian chờ"""
+        self.start_loading()
+        if not self._loaded.wait(self.ready_timeout if timeout is None else timeout):
+            raise RuntimeError("Sentiment model is still loading")
+        if self.state == "failed":
+            raise RuntimeError(f"Sentiment model failed to load: {self.load_error}")
+
+    def load_model(self, version: str, model_path: str, backend: str = None, truncation: str = None,
+                   intra_op_threads: int = None) -> Dict:
+        """Nạp thêm một checkpoint vào registry (blocking, gồm cả warm-up), chưa phục vụ request"""
+        loaded = self.registry.load(version, model_path, backend or self.backend_name, truncation or self.truncation,
+                                    intra_op_threads)
+        if loaded.state != "ready":
+            raise RuntimeError(f"Model {version} failed to load: {loaded.error}")
+        return loaded.info()
+
+    def activate_model(self, version: str) -> Dict:
+        """Chuyển model đang phục vụ; batch đang chạy vẫn hoàn tất trên model cũ"""
+        loaded = self.registry.activate(version)
+        # Kết quả đã cache thuộc về model cũ
+        self.cache.switch_namespace(loaded.cache_namespace)
+        if self.state != "ready":
+            # Model mặc định chưa nạp xong hoặc nạp lỗi: phục vụ bằng model vừa kích hoạt
+            self.state = "ready"
+            self.load_error = None
+            self._loaded.set()
+        return loaded.info()
+
     async def analyze_and_broadcast(self, text: str, comment_id: str, db: Session = None):
         try:
             start_time = time.time()
             metrics_service = MetricsService(db)  # Truyền session trực tiếp
-            # Phân tích sentiment
-            result = self.analyze_text(text) if self.model else {'sentiment': 'positive', 'score': 0.5}
+            # Phân tích sentiment, chờ trong hàng đợi nếu model chưa nạp xong
+            result = await self.analyze_text_async(text)
             sentiment = result['sentiment'].lower()
             
             print(f"Analyzed sentiment for comment {comment_id}: {sentiment}")
@@ -56,43 +128,107 @@ class SentimentAnalyzer:
             # Log prediction nếu có metrics_service
             if metrics_service is not None:
                 response_time = (time.time() - start_time) * 1000  # Convert to ms
+                predicted_at = datetime.utcnow()
                 metrics_service.log_prediction(
                     text=text,
                     prediction=sentiment,
                     confidence=float(result['score']),
                     response_time=response_time,
-                    comment_id=comment_id
+                    comment_id=comment_id,
+                    model_version=result.get('model_version'),
+                    timestamp=predicted_at
                 )
                 
-                # Tính toán batch metrics mỗi giờ
-                metrics_service.calculate_batch_metrics()
+                # Cộng vào metrics theo phút, được ghi xuống metrics_rollups theo chu kỳ
+                metrics_aggregator.record_prediction(
+                    sentiment, float(result['score']), response_time, at=predicted_at
+                )
+
+                # So sánh với model ứng viên trên một phần traffic, không chờ kết quả
+                self.shadow.observe(text, comment_id, result, response_time)
             
             # Broadcast kết quả qua WebSocket
             await manager.broadcast_sentiment_update(comment_id, sentiment)
             print(f"Broadcasted sentiment update for comment {comment_id}")
             
             return sentiment
+        except InferenceQueueFull as e:
+            # Comment vẫn được lưu với sentiment null; caller chuyển nó cho scoring queue
+            print(f"Inference queue full, comment {comment_id} left unscored: {e}")
+            return None
         except Exception as e:
             print(f"Error in analyze_and_broadcast: {e}")
             return None
 
-    def analyze(self, text: str) -> str:
-        """Return simple sentiment analysis result"""
+    def is_saturated(self) -> bool:
+        """True khi hàng đợi inference đã đầy và request mới nên bị từ chối"""
+        return self.batcher.is_saturated()
+
+    def analyze(self, text: str) -> Optional[str]:
+        """Return simple sentiment analysis result, None if the model could not score it"""
         try:
-            if self.model is None:
-                # Fallback simple analysis
-                result = {'sentiment': 'positive' if len(text) % 2 == 0 else 'negative', 'score': 0.5}
-            else:
-                result = self.analyze_text(text)
-            
-            return result['sentiment'].lower()
+            return self.analyze_text(text)['sentiment'].lower()
         except Exception as e:
             print(f"Error in sentiment analysis: {e}")
-            return "positive"  # Default fallback
+            return None
     
     def analyze_text(self, text: str) -> Dict:
         """Detailed sentiment analysis with confidence"""
-        result = self.model(text)[0]
+        cached = self.cache.get(text)
+        if cached is not None:
+            return cached
+        result = self._format_result(self.batcher.submit(text).result())
+        self.cache.set(text, result, namespace=self._namespace_of(result))
+        return result
+
+    async def analyze_text_async(self, text: str) -> Dict:
+        """Same as analyze_text, but awaits the batch without blocking the event loop"""
+        cached = await self.cache.get_async(text)
+        if cached is not None:
+            return cached
+        result = self._format_result(await asyncio.wrap_future(self.batcher.submit(text)))
+        self.cache.set(text, result, namespace=self._namespace_of(result))
+        return result
+
+    def analyze_batch(self, texts: List[str]) -> List[Dict]:
+        """Score a large list of texts in one call, bypassing the request micro-batcher.
+
+        Chỉ BULK_MAX_CONCURRENCY lượt chạy cùng lúc (các lượt khác chờ), mỗi forward pass
+        tối đa BULK_FORWARD_BATCH_SIZE text, và trước mỗi pass chờ tối đa BULK_MAX_YIELD_S
+        nếu hàng đợi của request thật đang có việc.
+
+        Không dùng prediction cache: backfill chủ yếu là text chỉ gặp một lần và sẽ đẩy
+        các kết quả hay dùng của traffic thật ra khỏi LRU.
+        """
+        results = []
+        with self.bulk_slots:
+            for start in range(0, len(texts), self.bulk_forward_batch_size):
+                self._yield_to_live_traffic()
+                predictions = self._predict_batch(texts[start:start + self.bulk_forward_batch_size])
+                results.extend(self._format_result(prediction) for prediction in predictions)
+        return results
+
+    def _yield_to_live_traffic(self):
+        deadline = time.monotonic() + self.bulk_max_yield_s
+        while self.batcher.queue_depth > 0 and time.monotonic() < deadline:
+            time.sleep(0.005)
+
+    def _predict_batch(self, texts: List[str]) -> List[Dict]:
+        """Score a micro-batch, waiting for the model if it is still loading"""
+        self.wait_until_ready()
+        return self._run_batch(texts)
+
+    def _run_batch(self, texts: List[str]) -> List[Dict]:
+        # Lấy model một lần cho cả batch: đổi model giữa chừng không ảnh hưởng batch này
+        return self.registry.active.predict(texts)
+
+    def _namespace_of(self, result: Dict) -> str:
+        loaded = self.registry.get(result.get('model_version'))
+        # Model đã bị gỡ khỏi registry thì không cache kết quả của nó
+        return loaded.cache_namespace if loaded else ""
+
+    @staticmethod
+    def _format_result(result: Dict) -> Dict:
         sentiment = 'POSITIVE' if result['label'] == 'LABEL_1' else 'NEGATIVE'
         
         if result['score'] > 0.9:
@@ -107,6 +243,7 @@ class SentimentAnalyzer:
         return {
             'sentiment': sentiment,
             'confidence': confidence,
-            'score': float(result['score'])
+            'score': float(result['score']),
+            'model_version': result.get('model_version')
         } 
 
@@ -0,0 +1,299 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import case, func
+from sqlalchemy.orm import Session
+
+from .batching import InferenceQueueFull, MicroBatcher
+from .models import ShadowPrediction
+from .prediction_log_writer import PredictionLogWriter
+
+CONFIDENCE_BINS = [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+
+class _ModelStats:
+    """Latency và confidence của một model trên các comment được lấy mẫu"""
+
+    def __init__(self, window: int):
+        self.predictions = 0
+        self.positive = 0
+        self.latencies = deque(maxlen=window)
+        self.confidences = deque(maxlen=window)
+        self.corrections = 0
+        self.correct = 0
+
+    def add_totals(self, predictions: int, positive: int, corrections: int, correct: int):
+        self.predictions += predictions
+        self.positive += positive
+        self.corrections += corrections
+        self.correct += correct
+
+    def record(self, confidence: float, latency_ms: float):
+        self.latencies.append(latency_ms)
+        self.confidences.append(confidence)
+
+    def summary(self) -> Dict:
+        latencies = np.asarray(self.latencies, dtype=float)
+        confidences = np.asarray(self.confidences, dtype=float)
+        histogram = np.histogram(confidences, bins=CONFIDENCE_BINS)[0] if confidences.size else [0] * (len(CONFIDENCE_BINS) - 1)
+        return {
+            "predictions": self.predictions,
+            "positive_rate": self.positive / self.predictions if self.predictions else 0.0,
+            "latency_ms": {
+                "mean": round(float(latencies.mean()), 2) if latencies.size else 0.0,
+                **{f"p{q}": round(float(np.percentile(latencies, q)), 2) if latencies.size else 0.0 for q in (50, 95, 99)}
+            },
+            "confidence": {
+                "mean": round(float(confidences.mean()), 4) if confidences.size else 0.0,
+                "p10": round(float(np.percentile(confidences, 10)), 4) if confidences.size else 0.0,
+                "p50": round(float(np.percentile(confidences, 50)), 4) if confidences.size else 0.0,
+                "histogram": {
+                    f"{low:.1f}-{high:.1f}": int(count)
+                    for low, high, count in zip(CONFIDENCE_BINS, CONFIDENCE_BINS[1:], histogram)
+                }
+            },
+            "corrections": self.corrections,
+            "accuracy_on_corrections": self.correct / self.corrections if self.corrections else None
+        }
+
+
+class _PrimaryBusy(Exception):
+    """Batch shadow bị bỏ vì model chính có request đang chờ"""
+
+
+class ShadowScorer:
+    """Chấm điểm song song một phần comment bằng model ứng viên, không ảnh hưởng kết quả trả về.
+
+    Model ứng viên chạy trên MicroBatcher riêng (một worker, hàng đợi nhỏ) nên không
+    chiếm worker hay chỗ trong hàng đợi của model chính. Comment chỉ được lấy mẫu khi
+    hàng đợi chính đang trống, và batch shadow bị bỏ nếu lúc bắt đầu chạy model chính
+    đã có request chờ; khi quá SHADOW_MAX_PER_SECOND hoặc hàng đợi shadow đầy thì bỏ
+    qua mẫu đó thay vì chờ. Việc lấy mẫu dựa trên hash của comment_id nên ổn định giữa
+    các lần thử lại.
+
+    Kết quả của hai model được ghi theo lô vào bảng shadow_predictions, nên thống kê
+    (GET /api/shadow) gộp mẫu của mọi worker; các bộ đếm bỏ mẫu (skipped_*, dropped,
+    errors) là của worker trả lời request.
+
+    Các backend torch dùng chung thread pool intra-op của cả process
+    (torch.set_num_threads là toàn cục), nên một forward pass shadow đã bắt đầu vẫn
+    tranh CPU với batch của model chính. Vì vậy model ứng viên phải là backend onnx nạp
+    với `intra_op_threads` (POST /api/models), trừ khi đặt SHADOW_ALLOW_SHARED_THREADS=1
+    để chấp nhận chi phí đó; khi ấy shadow chỉ được chặn bởi batch nhỏ
+    (SHADOW_MAX_BATCH_SIZE) và tốc độ lấy mẫu (SHADOW_MAX_PER_SECOND).
+    """
+
+    def __init__(self, registry, primary_batcher: MicroBatcher, sample_rate: Optional[float] = None,
+                 max_queue_size: Optional[int] = None, stats_window: Optional[int] = None,
+                 max_per_second: Optional[float] = None):
+        self.registry = registry
+        self.primary_batcher = primary_batcher
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("SHADOW_SAMPLE_RATE", "0.1"))
+        self.stats_window = stats_window or int(os.getenv("SHADOW_STATS_WINDOW", "1000"))
+        self.candidate_version: Optional[str] = os.getenv("SHADOW_MODEL_VERSION") or None
+        # 0 = không giới hạn số mẫu mỗi giây
+        self.max_per_second = max_per_second if max_per_second is not None else float(os.getenv("SHADOW_MAX_PER_SECOND", "20"))
+        self.allow_shared_threads = os.getenv("SHADOW_ALLOW_SHARED_THREADS", "0") == "1"
+        self._tokens = max(self.max_per_second, 1.0)
+        self._refilled_at = time.monotonic()
+        self.batcher = MicroBatcher(
+            self._predict_batch,
+            max_batch_size=int(os.getenv("SHADOW_MAX_BATCH_SIZE", "4")),
+            num_workers=1,
+            max_queue_size=max_queue_size or int(os.getenv("SHADOW_MAX_QUEUE_SIZE", "64"))
+        )
+        self.log_writer = PredictionLogWriter(model=ShadowPrediction)
+        self._lock = threading.Lock()
+        self.skipped_busy = 0
+        self.skipped_rate = 0
+        self.skipped_shared_threads = 0
+        self.dropped = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.candidate_version is not None and self.sample_rate > 0
+
+    def _isolated(self, candidate) -> bool:
+        """Model ứng viên có thread pool riêng (onnx + intra_op_threads) hoặc đã opt-in dùng chung"""
+        if self.allow_shared_threads:
+            return True
+        return candidate.backend_name == "onnx" and candidate.intra_op_threads is not None
+
+    def configure(self, version: Optional[str], sample_rate: Optional[float] = None):
+        if version is not None:
+            candidate = self.registry.get(version)
+            if candidate is None:
+                raise KeyError(f"Model version {version} is not loaded")
+            if not self._isolated(candidate):
+                raise ValueError(
+                    f"Model version {version} (backend {candidate.backend_name}) would share the primary "
+                    "model's CPU threads; load it with backend onnx and intra_op_threads, "
+                    "or set SHADOW_ALLOW_SHARED_THREADS=1"
+                )
+        if sample_rate is not None:
+            if not 0 <= sample_rate <= 1:
+                raise ValueError("sample_rate must be between 0 and 1")
+            self.sample_rate = sample_rate
+        self.candidate_version = version
+
+    def _take_token(self) -> bool:
+        """Token bucket giới hạn số mẫu gửi sang model ứng viên mỗi giây"""
+        if self.max_per_second <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(self.max_per_second, 1.0),
+                               self._tokens + (now - self._refilled_at) * self.max_per_second)
+            self._refilled_at = now
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+    def _sampled(self, comment_id: str) -> bool:
+        bucket = int(hashlib.sha1(comment_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return bucket < self.sample_rate
+
+    def observe(self, text: str, comment_id: str, primary: Dict, primary_latency_ms: float):
+        """Gọi sau khi model chính đã chấm điểm; chỉ đưa vào hàng đợi shadow, không bao giờ chờ"""
+        version = self.candidate_version
+        if not self.enabled or not self._sampled(comment_id):
+            return
+        if version == primary.get("model_version"):
+            return
+        # SHADOW_MODEL_VERSION không đi qua configure: kiểm tra lại khi model đã nạp
+        candidate = self.registry.get(version)
+        if candidate is not None and not self._isolated(candidate):
+            self.skipped_shared_threads += 1
+            return
+        if self.primary_batcher.queue_depth > 0:
+            self.skipped_busy += 1
+            return
+        if not self._take_token():
+            self.skipped_rate += 1
+            return
+        started = time.perf_counter()
+        try:
+            future = self.batcher.submit(text)
+        except InferenceQueueFull:
+            self.dropped += 1
+            return
+        future.add_done_callback(
+            lambda f: self._record(f, comment_id, primary, primary_latency_ms, started)
+        )
+
+    def _predict_batch(self, texts: List[str]) -> List[Dict]:
+        candidate = self.registry.get(self.candidate_version) if self.candidate_version else None
+        if candidate is None:
+            raise RuntimeError("Shadow model is not loaded")
+        # Model chính có request mới trong lúc batch này chờ: nhường CPU cho nó
+        if self.primary_batcher.queue_depth > 0:
+            raise _PrimaryBusy()
+        return candidate.predict(texts)
+
+    def _record(self, future, comment_id: str, primary: Dict, primary_latency_ms: float, started: float):
+        latency_ms = (time.perf_counter() - started) * 1000
+        error = future.exception()
+        if isinstance(error, _PrimaryBusy):
+            self.skipped_busy += 1
+            return
+        if error is not None:
+            self.errors += 1
+            return
+        shadow = future.result()
+        # Chạy trên thread của batcher shadow; writer ghi theo lô, không ghi DB trên đường request
+        self.log_writer.add({
+            "id": str(uuid.uuid4()),
+            "timestamp": datetime.utcnow(),
+            "comment_id": comment_id,
+            "primary_version": primary.get("model_version") or "unknown",
+            "primary_sentiment": primary["sentiment"].lower(),
+            "primary_confidence": primary["score"],
+            "primary_latency_ms": primary_latency_ms,
+            "shadow_version": shadow["model_version"],
+            "shadow_sentiment": "positive" if shadow["label"] == "LABEL_1" else "negative",
+            "shadow_confidence": shadow["score"],
+            "shadow_latency_ms": latency_ms
+        })
+
+    def record_correction(self, db: Session, comment_id: str, sentiment: str):
+        """Lưu nhãn người dùng sửa vào các mẫu shadow của comment để so accuracy của hai model"""
+        sentiment = sentiment.lower()
+        buffered = self.log_writer.find_latest(comment_id)
+        if buffered is not None:
+            buffered["corrected_sentiment"] = sentiment
+        try:
+            db.query(ShadowPrediction).filter(ShadowPrediction.comment_id == comment_id).update(
+                {ShadowPrediction.corrected_sentiment: sentiment}, synchronize_session=False
+            )
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            print(f"Error recording shadow correction: {e}")
+
+    def _persisted_stats(self, db: Session, version: str):
+        """Thống kê của model ứng viên `version` từ shadow_predictions của mọi worker"""
+        sp = ShadowPrediction
+        totals = db.query(
+            sp.primary_version,
+            func.count(sp.id),
+            func.sum(case((sp.primary_sentiment == sp.shadow_sentiment, 1), else_=0)),
+            func.sum(case((sp.primary_sentiment == "positive", 1), else_=0)),
+            func.sum(case((sp.shadow_sentiment == "positive", 1), else_=0)),
+            func.count(sp.corrected_sentiment),
+            func.sum(case((sp.primary_sentiment == sp.corrected_sentiment, 1), else_=0)),
+            func.sum(case((sp.shadow_sentiment == sp.corrected_sentiment, 1), else_=0))
+        ).filter(sp.shadow_version == version).group_by(sp.primary_version).all()
+
+        models: Dict[str, _ModelStats] = {}
+        agreement = {}
+        for primary_version, compared, agreed, primary_pos, shadow_pos, corrections, primary_ok, shadow_ok in totals:
+            agreed = int(agreed or 0)
+            agreement[f"{primary_version}:{version}"] = {
+                "compared": compared, "agreed": agreed,
+                "agreement_rate": agreed / compared if compared else 0.0
+            }
+            self._stats(models, primary_version).add_totals(compared, int(primary_pos or 0), corrections, int(primary_ok or 0))
+            self._stats(models, version).add_totals(compared, int(shadow_pos or 0), corrections, int(shadow_ok or 0))
+
+        # Phân phối latency/confidence lấy từ `stats_window` mẫu mới nhất
+        recent = db.query(sp).filter(sp.shadow_version == version).order_by(sp.timestamp.desc()).limit(self.stats_window).all()
+        for row in reversed(recent):
+            self._stats(models, row.primary_version).record(row.primary_confidence, row.primary_latency_ms)
+            self._stats(models, version).record(row.shadow_confidence, row.shadow_latency_ms)
+        return models, agreement
+
+    def _stats(self, models: Dict[str, _ModelStats], version: str) -> _ModelStats:
+        stats = models.get(version)
+        if stats is None:
+            stats = models[version] = _ModelStats(self.stats_window)
+        return stats
+
+    def stats(self, db: Session) -> Dict:
+        version = self.candidate_version
+        models, agreement = self._persisted_stats(db, version) if version else ({}, {})
+        return {
+            "enabled": self.enabled,
+            "candidate": version,
+            "sample_rate": self.sample_rate,
+            "max_per_second": self.max_per_second,
+            "max_batch_size": self.batcher.max_batch_size,
+            "allow_shared_threads": self.allow_shared_threads,
+            "queue_depth": self.batcher.queue_depth,
+            "pending_writes": self.log_writer.depth,
+            "skipped_busy": self.skipped_busy,
+            "skipped_rate": self.skipped_rate,
+            "skipped_shared_threads": self.skipped_shared_threads,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "agreement": agreement,
+            "models": {name: stats.summary() for name, stats in models.items()}
+        }
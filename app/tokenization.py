@@ -0,0 +1,178 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .inference_backends import softmax
+from .instrumentation import FORWARD_PASS_SECONDS, TOKENIZATION_SECONDS
+
+TRUNCATION_STRATEGIES = ("head", "head_tail", "sliding_window")
+
+
+class _BucketStats:
+    __slots__ = ("batches", "rows", "tokens", "padded_tokens", "latency_sum", "latency_max")
+
+    def __init__(self):
+        self.batches = 0
+        self.rows = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+
+class TokenizationStage:
+    """Tokenize, cắt ngắn và gom batch theo độ dài token trước khi chạy model.
+
+    Mỗi text được tokenize một lần bằng fast tokenizer (không cắt), sau đó cắt theo
+    `strategy`:
+      - head: giữ `max_length` token đầu
+      - head_tail: giữ `head_tokens` token đầu và phần còn lại lấy từ cuối review
+      - sliding_window: chia thành các cửa sổ chồng nhau `stride` token, điểm của
+        review là trung bình xác suất của các cửa sổ
+    Các đoạn được sắp theo độ dài và chia vào bucket `bucket_boundaries`; mỗi bucket
+    chỉ pad tới đoạn dài nhất của nó nên review dài không làm tăng chi phí của cả batch.
+    """
+
+    def __init__(self, tokenizer, max_length: Optional[int] = None, strategy: Optional[str] = None,
+                 head_tokens: Optional[int] = None, stride: Optional[int] = None,
+                 bucket_boundaries: Optional[List[int]] = None, max_rows: Optional[int] = None):
+        self.tokenizer = tokenizer
+        model_max = getattr(tokenizer, "model_max_length", 512) or 512
+        self.max_length = min(max_length or int(os.getenv("SENTIMENT_MAX_LENGTH", "512")), model_max)
+        self.strategy = strategy or os.getenv("SENTIMENT_TRUNCATION", "head_tail")
+        if self.strategy not in TRUNCATION_STRATEGIES:
+            raise ValueError(f"Unknown truncation strategy: {self.strategy}")
+        # Số token nội dung còn lại sau khi thêm [CLS] và [SEP]
+        self.budget = self.max_length - tokenizer.num_special_tokens_to_add(pair=False)
+        self.head_tokens = min(head_tokens or int(os.getenv("SENTIMENT_HEAD_TOKENS", "128")), self.budget)
+        self.stride = min(stride or int(os.getenv("SENTIMENT_WINDOW_STRIDE", "128")), self.budget // 2)
+        boundaries = bucket_boundaries or [
+            int(b) for b in os.getenv("SENTIMENT_LENGTH_BUCKETS", "32,64,128,256,512").split(",") if b.strip()
+        ]
+        self.bucket_boundaries = sorted({b for b in boundaries if b < self.max_length} | {self.max_length})
+        self.max_rows = max_rows or int(os.getenv("SENTIMENT_BUCKET_MAX_ROWS", "64"))
+        self.pad_token_id = tokenizer.pad_token_id or 0
+
+        self._lock = threading.Lock()
+        self._buckets: Dict[int, _BucketStats] = {b: _BucketStats() for b in self.bucket_boundaries}
+        self._tokenize_calls = 0
+        self._tokenize_texts = 0
+        self._tokenize_seconds = 0.0
+        self._truncated = 0
+        self._windows = 0
+
+    def _segments(self, ids: List[int]) -> List[List[int]]:
+        if len(ids) <= self.budget:
+            return [ids]
+        if self.strategy == "head":
+            return [ids[:self.budget]]
+        if self.strategy == "head_tail":
+            tail = self.budget - self.head_tokens
+            return [ids[:self.head_tokens] + (ids[-tail:] if tail else [])]
+        step = self.budget - self.stride
+        segments = []
+        for start in range(0, len(ids), step):
+            segments.append(ids[start:start + self.budget])
+            if start + self.budget >= len(ids):
+                break
+        return segments
+
+    def encode(self, texts: List[str]) -> Tuple[List[List[int]], List[int]]:
+        """Trả về các đoạn token (đã có special token) và chỉ số text sở hữu mỗi đoạn"""
+        started = time.perf_counter()
+        token_ids = self.tokenizer(texts, add_special_tokens=False, truncation=False, verbose=False)["input_ids"]
+        segments, owners = [], []
+        truncated = windows = 0
+        for index, ids in enumerate(token_ids):
+            parts = self._segments(ids)
+            if len(ids) > self.budget:
+                truncated += 1
+                windows += len(parts)
+            for part in parts:
+                segments.append(self.tokenizer.build_inputs_with_special_tokens(part))
+                owners.append(index)
+        elapsed = time.perf_counter() - started
+        TOKENIZATION_SECONDS.observe(elapsed)
+        with self._lock:
+            self._tokenize_calls += 1
+            self._tokenize_texts += len(texts)
+            self._tokenize_seconds += elapsed
+            self._truncated += truncated
+            self._windows += windows
+        return segments, owners
+
+    def _pad(self, rows: List[List[int]]) -> Dict[str, np.ndarray]:
+        width = max(len(row) for row in rows)
+        input_ids = np.full((len(rows), width), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(rows), width), dtype=np.int64)
+        for i, row in enumerate(rows):
+            input_ids[i, :len(row)] = row
+            attention_mask[i, :len(row)] = 1
+        return {"input_ids": input_ids, "attention_mask": attention_mask}
+
+    def predict(self, texts: List[str], predict_logits: Callable[[Dict[str, np.ndarray]], np.ndarray]) -> np.ndarray:
+        """Xác suất (len(texts), num_labels), chạy một forward pass cho mỗi nhóm độ dài"""
+        segments, owners = self.encode(texts)
+        order = sorted(range(len(segments)), key=lambda i: len(segments[i]))
+        groups: Dict[int, List[int]] = {}
+        for i in order:
+            bucket = self.bucket_boundaries[bisect_left(self.bucket_boundaries, len(segments[i]))]
+            groups.setdefault(bucket, []).append(i)
+
+        probabilities: List[Optional[np.ndarray]] = [None] * len(segments)
+        for bucket, indices in groups.items():
+            for start in range(0, len(indices), self.max_rows):
+                chunk = indices[start:start + self.max_rows]
+                rows = [segments[i] for i in chunk]
+                encoded = self._pad(rows)
+                started = time.perf_counter()
+                chunk_probs = softmax(predict_logits(encoded))
+                self._record(bucket, rows, encoded, time.perf_counter() - started)
+                for i, probs in zip(chunk, chunk_probs):
+                    probabilities[i] = probs
+
+        # Gộp các cửa sổ của cùng một review bằng trung bình xác suất
+        totals = np.zeros((len(texts), probabilities[0].shape[-1]))
+        counts = np.zeros(len(texts))
+        for owner, probs in zip(owners, probabilities):
+            totals[owner] += probs
+            counts[owner] += 1
+        return totals / counts[:, None]
+
+    def _record(self, bucket: int, rows: List[List[int]], encoded: Dict[str, np.ndarray], seconds: float):
+        FORWARD_PASS_SECONDS.labels(bucket=bucket).observe(seconds)
+        with self._lock:
+            stats = self._buckets[bucket]
+            stats.batches += 1
+            stats.rows += len(rows)
+            stats.tokens += sum(len(row) for row in rows)
+            stats.padded_tokens += encoded["input_ids"].size
+            stats.latency_sum += seconds
+            stats.latency_max = max(stats.latency_max, seconds)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            buckets = {
+                f"<={bucket}": {
+                    "batches": s.batches,
+                    "rows": s.rows,
+                    "avg_latency_ms": round(s.latency_sum / s.batches * 1000, 2) if s.batches else 0.0,
+                    "max_latency_ms": round(s.latency_max * 1000, 2),
+                    "avg_rows_per_batch": round(s.rows / s.batches, 2) if s.batches else 0.0,
+                    "padding_ratio": round(1 - s.tokens / s.padded_tokens, 4) if s.padded_tokens else 0.0
+                }
+                for bucket, s in self._buckets.items()
+            }
+            return {
+                "strategy": self.strategy,
+                "max_length": self.max_length,
+                "texts": self._tokenize_texts,
+                "truncated_texts": self._truncated,
+                "sliding_windows": self._windows,
+                "avg_tokenize_ms": round(self._tokenize_seconds / self._tokenize_calls * 1000, 2) if self._tokenize_calls else 0.0,
+                "buckets": buckets
+            }
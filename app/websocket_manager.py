@@ -1,144 +1,252 @@
 from fastapi import WebSocket, WebSocketDisconnect
-from typing import List, Dict
+from typing import List, Dict, Optional, Set
 import json
+import os
+import time
 from datetime import datetime
 from sqlalchemy.orm import Session
 from app import   crud
 import asyncio
 from starlette.websockets import WebSocketState
-from app.database import get_db
+from app.database import session_scope
 from app.models import CommentDB, BookDB
-from app.metrics_service import MetricsService
+from app.pubsub import create_backend
+from app.instrumentation import WS_BROADCAST_SECONDS
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))
+# "drop_oldest": bỏ message cũ nhất của client chậm; "disconnect": ngắt kết nối client chậm
+WS_SLOW_CLIENT_POLICY = os.getenv("WS_SLOW_CLIENT_POLICY", "drop_oldest")
+# Gom các cập nhật stats trong cửa sổ này thành một lần gửi
+WS_STATS_WINDOW_MS = float(os.getenv("WS_STATS_WINDOW_MS", "250"))
+
+def serialize_message(message: dict) -> str:
+    # Cùng định dạng với WebSocket.send_json
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+class ClientConnection:
+    """Một WebSocket client với hàng đợi gửi riêng, được xả bởi task riêng của client"""
+
+    def __init__(self, websocket: WebSocket, on_error, max_queue_size: int = WS_SEND_QUEUE_SIZE,
+                 policy: str = WS_SLOW_CLIENT_POLICY):
+        self.websocket = websocket
+        self.policy = policy
+        self.dropped = 0
+        # None = nhận tất cả; client gửi {"type": "subscribe", ...} để chỉ nhận một phần
+        self.book_ids: Optional[Set[str]] = None
+        self.message_types: Optional[Set[str]] = None
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_queue_size)
+        self._on_error = on_error
+        self._task = asyncio.create_task(self._drain())
+
+    def wants(self, message_type: str, book_id: Optional[str]) -> bool:
+        if self.message_types is not None and message_type not in self.message_types:
+            return False
+        if self.book_ids is not None and book_id is not None and book_id not in self.book_ids:
+            return False
+        return True
+
+    def enqueue(self, payload: str) -> bool:
+        """Đưa message đã serialize vào hàng đợi; trả về False nếu client cần bị ngắt"""
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == "disconnect":
+                return False
+            self.queue.get_nowait()
+            self.queue.put_nowait(payload)
+            self.dropped += 1
+            return True
+
+    async def _drain(self):
+        try:
+            while True:
+                payload = await self.queue.get()
+                if self.websocket.application_state == WebSocketState.DISCONNECTED:
+                    break
+                await self.websocket.send_text(payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error sending to client: {e}")
+        await self._on_error(self)
+
+    async def close(self, code: int = None):
+        if self._task is not asyncio.current_task():
+            self._task.cancel()
+        if code is not None and self.websocket.application_state != WebSocketState.DISCONNECTED:
+            try:
+                await self.websocket.close(code=code)
+            except Exception:
+                pass
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, ClientConnection] = {}
+        # Snapshot stats gần nhất đã gửi cho client
         self.sentiment_stats = {"positive": 0, "negative": 0}
         self.lock = asyncio.Lock()
+        self.pubsub = create_backend()
+        self.stats_window = WS_STATS_WINDOW_MS / 1000
+        self._stats_dirty = False
+        self._dirty_books: Set[str] = set()
+        self._stats_task: Optional[asyncio.Task] = None
 
     async def connect(self, websocket: WebSocket):
         async with self.lock:
-            self.active_connections.append(websocket)
+            self.active_connections[websocket] = ClientConnection(websocket, self._drop_client)
             print(f"Client connected. Total connections: {len(self.active_connections)}")
 
     async def disconnect(self, websocket: WebSocket):
         async with self.lock:
-            if websocket in self.active_connections:
-                self.active_connections.remove(websocket)
-                print(f"Client disconnected. Remaining: {len(self.active_connections)}")
+            client = self.active_connections.pop(websocket, None)
+        if client:
+            await client.close()
+            print(f"Client disconnected. Remaining: {len(self.active_connections)}")
+
+    async def _drop_client(self, client: ClientConnection, code: int = None):
+        if self.active_connections.get(client.websocket) is client:
+            del self.active_connections[client.websocket]
+            print(f"Dropped client. Remaining: {len(self.active_connections)}")
+        await client.close(code)
+
+    def subscribe(self, websocket: WebSocket, books: List[str] = None, types: List[str] = None):
+        """Giới hạn message gửi cho client theo sách và loại message; None là nhận tất cả"""
+        client = self.active_connections.get(websocket)
+        if client:
+            client.book_ids = {str(book_id) for book_id in books} if books else None
+            client.message_types = set(types) if types else None
+
+    async def start(self):
+        await self.pubsub.start(self._deliver)
+
+    async def stop(self):
+        await self.pubsub.stop()
+
+    def has_audience(self) -> bool:
+        """Có nơi nhận message: client local, hoặc client của worker khác qua pub/sub"""
+        return self.pubsub.cross_process or bool(self.active_connections)
+
+    def publish(self, message: dict, book_id: str = None):
+        """Phát message tới client của mọi worker thông qua pub/sub backend"""
+        self.pubsub.publish(message, book_id)
+
+    def _deliver(self, message: dict, book_id: str = None):
+        """Serialize một lần rồi đưa vào hàng đợi của từng client local, không chờ gửi xong"""
+        started = time.perf_counter()
+        payload = None
+        for client in list(self.active_connections.values()):
+            if not client.wants(message["type"], book_id):
+                continue
+            if payload is None:
+                payload = serialize_message(message)
+            if not client.enqueue(payload):
+                # 1013: Try Again Later, client quá chậm so với tốc độ broadcast
+                asyncio.create_task(self._drop_client(client, code=1013))
+        WS_BROADCAST_SECONDS.labels(type=message["type"]).observe(time.perf_counter() - started)
 
     async def broadcast(self, message: dict):
+        book_id = message.get("data", {}).get("bookId")
+        self.publish(message, book_id=book_id)
         if message["type"] == "new_comment" and message["data"]["sentiment"]:
-            self.update_stats(message["data"]["sentiment"])
-            # Gửi stats sau khi cập nhật
-            stats_message = {
-                "type": "stats",
-                "data": {
-                    "positive": self.sentiment_stats["positive"],
-                    "negative": self.sentiment_stats["negative"],
-                    "total": sum(self.sentiment_stats.values()),
-                    "positive_percentage": (self.sentiment_stats["positive"] / sum(self.sentiment_stats.values()) * 100) if sum(self.sentiment_stats.values()) > 0 else 0,
-                    "negative_percentage": (self.sentiment_stats["negative"] / sum(self.sentiment_stats.values()) * 100) if sum(self.sentiment_stats.values()) > 0 else 0
-                }
-            }
-            # Gửi một lần duy nhất cho mỗi kết nối
-            for connection in self.active_connections:
-                await connection.send_json(message)  # Gửi comment
-                await connection.send_json(stats_message)  # Gửi stats
-        else:
-            # Gửi message khác
-            for connection in self.active_connections:
-                await connection.send_json(message)
-
-    def update_stats(self, sentiment: str):
-        if sentiment in self.sentiment_stats:
-            self.sentiment_stats[sentiment] += 1
+            # Stats được gom lại và gửi sau, không gửi kèm mỗi comment
+            self.schedule_stats(book_id)
+
+    def schedule_stats(self, book_id: str = None):
+        """Đánh dấu stats đã thay đổi; snapshot mới nhất được gửi một lần mỗi cửa sổ"""
+        self._stats_dirty = True
+        if book_id:
+            self._dirty_books.add(str(book_id))
+        if self._stats_task is None or self._stats_task.done():
+            self._stats_task = asyncio.create_task(self._flush_stats())
+
+    async def _flush_stats(self):
+        while self._stats_dirty:
+            await asyncio.sleep(self.stats_window)
+            book_ids, self._dirty_books = self._dirty_books, set()
+            self._stats_dirty = False
+            if not self.has_audience():
+                continue
+            try:
+                overall, book_stats = await asyncio.to_thread(self._load_stats, book_ids)
+            except Exception as e:
+                print(f"Error loading stats: {e}")
+                continue
+            self.sentiment_stats = overall
+            self.publish({"type": "stats", "data": overall})
+            # Chỉ gửi stats của các sách vừa thay đổi
+            for stats in book_stats:
+                self.publish({"type": "book_stats", "data": [stats]}, book_id=stats["id"])
+
+    @staticmethod
+    def _load_stats(book_ids: Set[str]):
+        with session_scope() as db:
+            overall = crud.get_sentiment_stats(db)
+            book_stats = crud.get_all_book_sentiment_stats(db, book_ids=book_ids) if book_ids else []
+        return overall, book_stats
 
     async def send_stats(self, websocket: WebSocket):
-        await websocket.send_json({
-            "type": "stats",
-            "data": self.sentiment_stats
-        })
+        client = self.active_connections.get(websocket)
+        if client:
+            client.enqueue(serialize_message({
+                "type": "stats",
+                "data": self.sentiment_stats
+            }))
 
     async def broadcast_book_stats(self, db: Session):
-        books = crud.get_books(db)
-        book_stats = []
+        # Một query cho tất cả sách thay vì 3 COUNT cho mỗi sách
+        book_stats = crud.get_all_book_sentiment_stats(db)
         
-        for book in books:
-            stats = crud.get_sentiment_stats(db, book.id)
-            book_stats.append({
-                "id": book.id,
-                "title": book.title,
-                "stats": stats
-            })
-        
-        stats_message = {
+        self.publish({
             "type": "book_stats",
             "data": book_stats
-        }
-        
-        for connection in self.active_connections:
-            await connection.send_json(stats_message)
+        })
 
     async def broadcast_sentiment_update(self, comment_id: str, sentiment: str):
-        if not self.active_connections:
+        if not self.has_audience():
             print("No active connections")
             return
 
         try:
-            # Lấy database session
-            db = next(get_db())
-            
-            # Lấy thông tin comment và book
-            comment = db.query(CommentDB).filter(CommentDB.id == comment_id).first()
-            book = db.query(BookDB).filter(BookDB.id == comment.book_id).first()
-
-            if not comment:
-                print(f"Comment {comment_id} not found")
+            # Đọc DB ở thread riêng như _load_stats, không chặn event loop
+            message = await asyncio.to_thread(self._load_sentiment_update, comment_id, sentiment)
+            if message is None:
                 return
-
-            # Cập nhật metrics
-            try:
-                metrics_service = MetricsService(db)
-                metrics_service.calculate_batch_metrics()
-                metrics_service.log_sentiment_correction(comment_id, sentiment)
-                print("Metrics updated after sentiment correction")
-            except Exception as e:
-                print(f"Error updating metrics: {e}")
-
-            # Chuẩn bị message để broadcast
-            message = {
-                "type": "reviewUpdated",
-                "data": {
-                    "id": comment.id,
-                    "content": comment.content,
-                    "userId": comment.userId,
-                    "userName": comment.userName,
-                    "bookId": comment.book_id,
-                    "bookTitle": book.title if book else None,
-                    "sentiment": sentiment,
-                    "timestamp": comment.timestamp.isoformat(),
-                    "isEditing": False
-                }
-            }
-            
-            print("Message to be sent:", json.dumps(message, indent=2))
             
-            # Broadcast message
-            async with self.lock:
-                for connection in list(self.active_connections):
-                    try:
-                        if connection.application_state != WebSocketState.DISCONNECTED:
-                            await connection.send_json(message)
-                            print(f"Sent update successfully with full data")
-                    except Exception as e:
-                        print(f"Error sending to client: {e}")
-                        if connection in self.active_connections:
-                            self.active_connections.remove(connection)
+            print(f"Broadcasting sentiment update for comment {comment_id} to {len(self.active_connections)} local clients")
+            self.publish(message, book_id=message["data"]["bookId"])
+            self.schedule_stats(message["data"]["bookId"])
 
         except Exception as e:
             print(f"Error in broadcast_sentiment_update: {e}")
-        finally:
-            db.close()
+
+    def _load_sentiment_update(self, comment_id: str, sentiment: str):
+        # Session chỉ giữ trong lúc đọc DB, trả connection về pool trước khi gửi qua WebSocket
+        with session_scope() as db:
+            return self._build_sentiment_update(db, comment_id, sentiment)
+
+    def _build_sentiment_update(self, db: Session, comment_id: str, sentiment: str):
+        # Lấy thông tin comment và book
+        comment = db.query(CommentDB).filter(CommentDB.id == comment_id).first()
+        if not comment:
+            print(f"Comment {comment_id} not found")
+            return None
+        book = db.query(BookDB).filter(BookDB.id == comment.book_id).first()
+
+        # Chuẩn bị message để broadcast
+        return {
+            "type": "reviewUpdated",
+            "data": {
+                "id": comment.id,
+                "content": comment.content,
+                "userId": comment.userId,
+                "userName": comment.userName,
+                "bookId": comment.book_id,
+                "bookTitle": book.title if book else None,
+                "sentiment": sentiment,
+                "timestamp": comment.timestamp.isoformat(),
+                "isEditing": False
+            }
+        }
 
 manager = ConnectionManager() 
\ No newline at end of file
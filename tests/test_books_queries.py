@@ -0,0 +1,79 @@
+import os
+import tempfile
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Phải đặt trước khi import app: database đọc DATABASE_URL lúc import
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'books-queries.db')}"
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+
+from app import database, models
+from app.main import app
+
+BOOKS = 5
+COMMENTS_PER_BOOK = 4
+REPLIES_PER_COMMENT = 2
+# books + selectinload(comments) + selectinload(replies), không phụ thuộc số dòng
+EXPECTED_QUERIES = 3
+
+
+@pytest.fixture(scope="module")
+def client():
+    now = datetime.utcnow()
+    with database.session_scope() as db:
+        for b in range(BOOKS):
+            book_id = f"book-{b}"
+            db.add(models.BookDB(id=book_id, title=f"Book {b}", author="author", price=1.0,
+                                 description="", imageUrl=""))
+            for c in range(COMMENTS_PER_BOOK):
+                comment_id = str(uuid.uuid4())
+                db.add(models.CommentDB(id=comment_id, content=f"comment {c}", userId="u", userName="user",
+                                        sentiment="positive", timestamp=now - timedelta(minutes=c),
+                                        book_id=book_id))
+                for r in range(REPLIES_PER_COMMENT):
+                    db.add(models.ReplyDB(id=str(uuid.uuid4()), adminId="a", adminName="admin",
+                                          content=f"reply {r}", comment_id=comment_id))
+    # Không dùng context manager: không chạy startup (nạp model, worker nền)
+    return TestClient(app, base_url="http://localhost")
+
+
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(database.engine, "before_cursor_execute", before_cursor_execute)
+
+
+def test_list_books_query_count(client):
+    with count_queries() as statements:
+        response = client.get("/books")
+
+    assert response.status_code == 200
+    books = response.json()
+    assert len(books) == BOOKS
+    assert all(len(book["comments"]) == COMMENTS_PER_BOOK for book in books)
+    assert all(len(comment["replies"]) == REPLIES_PER_COMMENT for book in books for comment in book["comments"])
+    assert len(statements) == EXPECTED_QUERIES, statements
+
+
+def test_get_book_query_count(client):
+    with count_queries() as statements:
+        response = client.get("/books/book-0")
+
+    assert response.status_code == 200
+    comments = response.json()["comments"]
+    assert len(comments) == COMMENTS_PER_BOOK
+    # Comment mới nhất đứng đầu
+    assert [comment["content"] for comment in comments] == [f"comment {c}" for c in range(COMMENTS_PER_BOOK)]
+    assert len(statements) == EXPECTED_QUERIES, statements